@@ -25,6 +25,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    # compress JSON API responses (static files are pre-compressed by WhiteNoise)
+    "django.middleware.gzip.GZipMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -60,11 +62,41 @@ DATABASES = {
         "PASSWORD": env("POSTGRES_PASSWORD", default="copilot"),
         "HOST": env("POSTGRES_HOST", default="db"),
         "PORT": env("POSTGRES_PORT", default="5432"),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
+# Connection reuse: psycopg3 pool (default) or persistent connections.
+# Django refuses pooling together with CONN_MAX_AGE, so only one is enabled.
+if env.bool("DB_POOL", default=True):
+    DATABASES["default"]["CONN_MAX_AGE"] = 0
+    DATABASES["default"]["OPTIONS"] = {
+        "pool": {
+            "min_size": env.int("DB_POOL_MIN", default=2),
+            "max_size": env.int("DB_POOL_MAX", default=10),
+            "timeout": env.int("DB_POOL_TIMEOUT", default=10),
+        }
+    }
+else:
+    DATABASES["default"]["CONN_MAX_AGE"] = env.int("DB_CONN_MAX_AGE", default=600)
+
 REDIS_URL = env("REDIS_URL", default="redis://redis:6379/0")
 
+# Response cache for read-only API endpoints (separate Redis db from Celery)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": env("CACHE_REDIS_URL", default="redis://redis:6379/1"),
+        "KEY_PREFIX": "copilot",
+        # cache reads sit in front of DB/LLM work: a hung Redis must fail fast
+        # (response_cache treats the error as a miss) instead of blocking requests
+        "OPTIONS": {
+            "socket_connect_timeout": env.float("CACHE_REDIS_CONNECT_TIMEOUT", default=0.5),
+            "socket_timeout": env.float("CACHE_REDIS_SOCKET_TIMEOUT", default=0.5),
+        },
+    }
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {"NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator"},
     {"NAME": "django.contrib.auth.password_validation.MinimumLengthValidator"},
@@ -102,6 +134,14 @@ CELERY_RESULT_BACKEND = REDIS_URL
 # Celery 6 compatibility
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
 
+# Celery's pooled broker sockets sit idle between uploads: keep them alive and bound
+# a stalled publish so it can't hang the web request that enqueues it.
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "socket_keepalive": True,
+    "socket_connect_timeout": env.float("CELERY_BROKER_CONNECT_TIMEOUT", default=2.0),
+    "socket_timeout": env.float("CELERY_BROKER_SOCKET_TIMEOUT", default=5.0),
+}
+
 # --- DRF: API is stateless (disable SessionAuthentication/CSRF) ---
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
@@ -111,5 +151,10 @@ REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.AllowAny",
     ],
+    # orjson-backed JSON encoding (stock JSONRenderer output, faster on large payloads)
+    "DEFAULT_RENDERER_CLASSES": [
+        "copilot.api.renderers.ORJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
 }
 
@@ -1,14 +1,86 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from .models import (
     Workspace, UserProfile, KnowledgeSource, Document, EmbeddingChunk,
     AgentRun, AgentStep, IdempotencyKey
 )
 
-admin.site.register(Workspace)
-admin.site.register(UserProfile)
-admin.site.register(KnowledgeSource)
-admin.site.register(Document)
-admin.site.register(EmbeddingChunk)
-admin.site.register(AgentRun)
-admin.site.register(AgentStep)
-admin.site.register(IdempotencyKey)
+# List pages show small scalar columns only; FKs use raw id inputs so change
+# forms don't load every related row into a <select>.
+
+
+class DeferringChangeList(ChangeList):
+    """Change list that skips the model admin's list_defer columns (change forms still load them)."""
+
+    def get_queryset(self, request, *args, **kwargs):
+        return super().get_queryset(request, *args, **kwargs).defer(*self.model_admin.list_defer)
+
+
+class BaseAdmin(admin.ModelAdmin):
+    list_per_page = 50
+    show_full_result_count = False
+    list_defer = ()  # large columns not in list_display: never read for list pages
+
+    def get_changelist(self, request, **kwargs):
+        return DeferringChangeList
+
+
+@admin.register(Workspace)
+class WorkspaceAdmin(BaseAdmin):
+    list_display = ("id", "name", "created_at")
+    search_fields = ("name",)
+
+
+@admin.register(UserProfile)
+class UserProfileAdmin(BaseAdmin):
+    list_display = ("id", "user", "workspace", "role", "monthly_cost_limit_usd")
+    list_select_related = ("user", "workspace")
+    raw_id_fields = ("user", "workspace")
+
+
+@admin.register(KnowledgeSource)
+class KnowledgeSourceAdmin(BaseAdmin):
+    list_display = ("id", "workspace_id", "kind", "name")
+    raw_id_fields = ("workspace",)
+
+
+@admin.register(Document)
+class DocumentAdmin(BaseAdmin):
+    list_display = ("id", "title", "status", "chunk_count", "created_at")
+    list_filter = ("status",)
+    search_fields = ("title", "filename")
+    raw_id_fields = ("workspace", "source")
+    list_defer = ("content",)
+
+
+@admin.register(EmbeddingChunk)
+class EmbeddingChunkAdmin(BaseAdmin):
+    list_display = ("id", "document_id", "chunk_index", "created_at")
+    raw_id_fields = ("document",)
+    exclude = ("embedding",)  # 1536 floats: never render in forms
+    list_defer = ("text", "meta", "embedding")
+
+
+@admin.register(AgentRun)
+class AgentRunAdmin(BaseAdmin):
+    list_display = ("id", "mode", "status", "cost_usd", "created_at")
+    list_filter = ("status", "mode")
+    search_fields = ("question",)
+    raw_id_fields = ("workspace", "user")
+    list_defer = ("question", "final_output", "error")
+
+
+@admin.register(AgentStep)
+class AgentStepAdmin(BaseAdmin):
+    list_display = ("id", "run_id", "name", "status", "created_at")
+    list_filter = ("name", "status")
+    raw_id_fields = ("run",)
+    list_defer = ("input_json", "output_json")
+
+
+@admin.register(IdempotencyKey)
+class IdempotencyKeyAdmin(BaseAdmin):
+    list_display = ("id", "key", "run_id", "created_at")
+    search_fields = ("key",)
+    raw_id_fields = ("workspace", "run")
+    list_defer = ("response_json",)
@@ -1,3 +1,5 @@
+import re
+
 from rest_framework import serializers
 from copilot.models import Document, AgentRun, AgentStep
 
@@ -22,74 +24,236 @@ class UploadTextSerializer(serializers.Serializer):
         attrs.pop("text", None)
         return attrs
 
+ASK_MODE_CHOICES = ("answer", "document", "automation")
+ASK_ANSWER_MODE_CHOICES = ("sources_only", "deterministic", "langchain_rag", "answer", "llm")
+ASK_RETRIEVER_CHOICES = ("auto", "vector", "keyword", "hybrid")
+ASK_TOP_K_MIN, ASK_TOP_K_MAX = 1, 50
+
 class AskSerializer(serializers.Serializer):
     question = serializers.CharField(required=True)
-    mode = serializers.ChoiceField(choices=["answer", "document", "automation"], default="answer")
-    answer_mode = serializers.ChoiceField(choices=["sources_only","deterministic","langchain_rag","answer","llm"], required=False, default="answer")
-    retriever = serializers.ChoiceField(choices=["auto","vector","keyword","hybrid"], default="auto", required=False)
-    top_k = serializers.IntegerField(required=False, default=5, min_value=1, max_value=50)
+    mode = serializers.ChoiceField(choices=list(ASK_MODE_CHOICES), default="answer")
+    answer_mode = serializers.ChoiceField(choices=list(ASK_ANSWER_MODE_CHOICES), required=False, default="answer")
+    retriever = serializers.ChoiceField(choices=list(ASK_RETRIEVER_CHOICES), default="auto", required=False)
+    top_k = serializers.IntegerField(required=False, default=5, min_value=ASK_TOP_K_MIN, max_value=ASK_TOP_K_MAX)
     document_id = serializers.IntegerField(required=False, allow_null=True)
 
+
+_MISSING = object()
+_INT_DECIMAL_RE = re.compile(r"\.0*\s*$")  # same as DRF IntegerField: "1.0" -> 1
+_ASK_CHOICES = (
+    ("mode", frozenset(ASK_MODE_CHOICES), "answer"),
+    ("answer_mode", frozenset(ASK_ANSWER_MODE_CHOICES), "answer"),
+    ("retriever", frozenset(ASK_RETRIEVER_CHOICES), "auto"),
+)
+
+
+def _ask_int(value):
+    if isinstance(value, str) and len(value) > 1000:
+        raise ValueError("String value too large.")
+    try:
+        return int(_INT_DECIMAL_RE.sub("", str(value)))
+    except (ValueError, TypeError):
+        raise ValueError("A valid integer is required.")
+
+
+def _ask_question(value) -> str:
+    if value is _MISSING:
+        raise ValueError("This field is required.")
+    if value is None:
+        raise ValueError("This field may not be null.")
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError("Not a valid string.")
+    q = str(value).strip()
+    if not q:
+        raise ValueError("This field may not be blank.")
+    if "\x00" in q:
+        raise ValueError("Null characters are not allowed.")
+    for ch in q:
+        if 0xD800 <= ord(ch) <= 0xDFFF:
+            raise ValueError(f"Surrogate characters are not allowed: U+{ord(ch):X}.")
+    return q
+
+
+# kb_upload_text reports only these entries (in this order), else its default
+UPLOAD_ERROR_KEYS = ("error", "non_field_errors", "content", "text")
+
+
+def first_error_message(errors, keys=None):
+    """
+    First message of a DRF errors structure. With keys, only those entries are
+    considered, in that order; otherwise non_field_errors wins, then field order.
+    """
+    if isinstance(errors, dict):
+        if keys is None:
+            keys = ("non_field_errors",) if "non_field_errors" in errors else tuple(errors)[:1]
+        msg = next((errors[k] for k in keys if k in errors), None)
+        if isinstance(msg, list) and msg:
+            msg = msg[0]
+        return msg
+    if isinstance(errors, list) and errors:
+        return errors[0]
+    return None
+
+
+def validate_ask(data) -> tuple:
+    """
+    Hot-path equivalent of AskSerializer for plain JSON objects (same defaults,
+    coercion and messages, first error only). Other payloads (form data, lists)
+    go through AskSerializer. Returns (validated_data, None) or (None, message).
+    """
+    if type(data) is not dict:
+        ser = AskSerializer(data=data)
+        if ser.is_valid():
+            return dict(ser.validated_data), None
+        return None, first_error_message(ser.errors)
+
+    try:
+        out = {"question": _ask_question(data.get("question", _MISSING))}
+    except ValueError as e:
+        return None, str(e)
+
+    for name, choices, default in _ASK_CHOICES:
+        value = data.get(name, _MISSING)
+        if value is _MISSING:
+            out[name] = default
+        elif value is None:
+            return None, "This field may not be null."
+        elif str(value) in choices:
+            out[name] = str(value)
+        else:
+            return None, f'"{value}" is not a valid choice.'
+
+    top_k = data.get("top_k", _MISSING)
+    if top_k is _MISSING:
+        out["top_k"] = 5
+    elif top_k is None:
+        return None, "This field may not be null."
+    else:
+        try:
+            top_k = _ask_int(top_k)
+        except ValueError as e:
+            return None, str(e)
+        if top_k > ASK_TOP_K_MAX:
+            return None, f"Ensure this value is less than or equal to {ASK_TOP_K_MAX}."
+        if top_k < ASK_TOP_K_MIN:
+            return None, f"Ensure this value is greater than or equal to {ASK_TOP_K_MIN}."
+        out["top_k"] = top_k
+
+    document_id = data.get("document_id", _MISSING)
+    if document_id is not _MISSING:
+        if document_id is None:
+            out["document_id"] = None
+        else:
+            try:
+                out["document_id"] = _ask_int(document_id)
+            except ValueError as e:
+                return None, str(e)
+    return out, None
+
+# Rendered columns: single source of truth for the ModelSerializers below and
+# for the values_list()/only() projections in the row renderers and views.
+DOCUMENT_FIELDS = ("id", "title", "filename", "mime", "status", "chunk_count", "created_at")
+AGENT_RUN_FIELDS = (
+    "id",
+    "question",
+    "mode",
+    "status",
+    "cost_usd",
+    "prompt_tokens",
+    "completion_tokens",
+    "created_at",
+)
+AGENT_RUN_DETAIL_FIELDS = (
+    "id",
+    "question",
+    "mode",
+    "status",
+    "final_output",
+    "error",
+    "cost_usd",
+    "prompt_tokens",
+    "completion_tokens",
+    "created_at",
+)
+AGENT_STEP_FIELDS = ("id", "run", "name", "status", "input_json", "output_json", "created_at")
+
 class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
-        fields = ["id", "title", "filename", "mime", "status", "chunk_count", "created_at"]
+        fields = DOCUMENT_FIELDS
 
 class AgentRunSerializer(serializers.ModelSerializer):
     class Meta:
         model = AgentRun
-        fields = [
-            "id",
-            "question",
-            "mode",
-            "status",
-            "cost_usd",
-            "prompt_tokens",
-            "completion_tokens",
-            "created_at",
-        ]
+        fields = AGENT_RUN_FIELDS
 
 class AgentRunDetailSerializer(serializers.ModelSerializer):
     class Meta:
         model = AgentRun
-        fields = [
-            "id",
-            "question",
-            "mode",
-            "status",
-            "final_output",
-            "error",
-            "cost_usd",
-            "prompt_tokens",
-            "completion_tokens",
-            "created_at",
-        ]
+        fields = AGENT_RUN_DETAIL_FIELDS
 
 class AgentStepSerializer(serializers.ModelSerializer):
     class Meta:
         model = AgentStep
-        fields = [
-            "id",
-            "name",
-            "status",
-            "input_json",
-            "output_json",
-            "created_at",
-        ]
-
-
-try:
-    from copilot.models import Run  # type: ignore
-except ImportError:
-    from copilot.models import AgentRun as Run  # type: ignore
-from copilot.models import AgentStep
-
-class RunSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Run
-        fields = "__all__"
+        fields = AGENT_STEP_FIELDS
 
-class AgentStepSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = AgentStep
-        fields = "__all__"
+
+# --------------------
+# Row renderers for hot list endpoints: same output as the ModelSerializers
+# above, built from values_list() tuples (no model instances, no field reflection).
+# --------------------
+
+_DT = serializers.DateTimeField()
+_COST = serializers.DecimalField(max_digits=10, decimal_places=4)
+
+# values_list() needs the FK column name
+STEP_ROW_FIELDS = tuple("run_id" if f == "run" else f for f in AGENT_STEP_FIELDS)
+
+
+def document_rows(qs) -> list:
+    return [
+        {
+            "id": doc_id,
+            "title": title,
+            "filename": filename,
+            "mime": mime,
+            "status": status,
+            "chunk_count": chunk_count,
+            "created_at": _DT.to_representation(created_at),
+        }
+        for doc_id, title, filename, mime, status, chunk_count, created_at
+        in qs.values_list(*DOCUMENT_FIELDS)
+    ]
+
+
+def run_rows(qs) -> list:
+    return [
+        {
+            "id": run_id,
+            "question": question,
+            "mode": mode,
+            "status": status,
+            "cost_usd": _COST.to_representation(cost_usd),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "created_at": _DT.to_representation(created_at),
+        }
+        for run_id, question, mode, status, cost_usd, prompt_tokens, completion_tokens, created_at
+        in qs.values_list(*AGENT_RUN_FIELDS)
+    ]
+
+
+def step_rows(qs) -> list:
+    return [
+        {
+            "id": step_id,
+            "run": run_id,
+            "name": name,
+            "status": status,
+            "input_json": input_json,
+            "output_json": output_json,
+            "created_at": _DT.to_representation(created_at),
+        }
+        for step_id, run_id, name, status, input_json, output_json, created_at
+        in qs.values_list(*STEP_ROW_FIELDS)
+    ]
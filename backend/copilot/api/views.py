@@ -1,33 +1,54 @@
+import codecs
 import hashlib
+import json
 import re
+import threading
 import uuid
+from pathlib import Path
 from typing import Optional
 
+import orjson
 from rest_framework.decorators import api_view, parser_classes
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework import status
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+from django.db.models.functions import Substr
+from django.shortcuts import get_object_or_404
 
 from copilot.models import Workspace, KnowledgeSource, Document, AgentRun, AgentStep, IdempotencyKey, EmbeddingChunk
 from copilot.api.serializers import (
     UploadTextSerializer,
-    DocumentSerializer,
-    AskSerializer,
-    AgentRunSerializer,
+    UPLOAD_ERROR_KEYS,
+    first_error_message,
+    validate_ask,
     AgentRunDetailSerializer,
-    AgentStepSerializer,
+    AGENT_RUN_DETAIL_FIELDS,
+    document_rows,
+    run_rows,
+    step_rows,
 )
 from copilot.tasks import process_document
 from copilot.services.retriever import keyword_retrieve
-from copilot.services.embeddings import embed_texts
+from copilot.services.embeddings import embed_query
 from copilot.services.vector_retriever import vector_retrieve
 from copilot.services.hybrid_retriever import hybrid_retrieve
-from copilot.services.idempotency import normalize_idempotency_key
+from copilot.services.hashing import sha256_text
+from copilot.services.idempotency import idempotency_key_from_request, upsert_idempotency_key
+from copilot.services.response_cache import (
+    cache_get,
+    cache_set,
+    LIST_TTL,
+    FINISHED_RUN_TTL,
+    FINISHED_RUN_STATUSES,
+    get_idempotent_replay,
+    set_idempotent_replay,
+)
 from copilot.services.llm import (
     rag_answer_openai,
     general_answer_openai,
-    repair_fallback_openai,
-    repair_doc_answer_openai,
     _strip_noise_sections,
     _normalize_general_output,
     detect_lang,
@@ -91,13 +112,19 @@ RU_TRIVIAL_TERMS = {
 }
 
 
+AUTHORISH_PATTERNS = (
+    # ru
+    "кто автор", "автор", "кто написал", "кто пишет", "как зовут", "имя автора",
+    # en
+    "who is the author", "author", "who wrote", "who writes", "what is your name", "who are you",
+)
+
+
 def _is_authorish_question(question: str) -> bool:
     q = (question or "").strip().lower()
     if not q:
         return False
-    ru = ("кто автор", "автор", "кто написал", "кто пишет", "как зовут", "имя автора")
-    en = ("who is the author", "author", "who wrote", "who writes", "what is your name", "who are you")
-    return any(k in q for k in (ru + en))
+    return any(k in q for k in AUTHORISH_PATTERNS)
 
 
 def _has_nontrivial_kw_terms(retrieved: list) -> bool:
@@ -113,32 +140,26 @@ def _has_nontrivial_kw_terms(retrieved: list) -> bool:
     return False
 
 
-def _is_doc_metadata_question(question: str) -> bool:
-    q = (question or "").strip().lower()
-    return bool(q) and any(a in q for a in DOC_META_ANCHORS) and any(i in q for i in DOC_META_INTENTS)
-
-
 @api_view(["GET"])
 def health(request):
     return Response({"status": "ok"})
 
 
-def sha256_text(text: str) -> str:
-    return hashlib.sha256(text.encode("utf-8")).hexdigest()
-
 def deterministic_synthesis(question: str, retrieved: list[dict]) -> str:
     """Deterministic fallback: stitch top snippets and add source refs [i]."""
     if not retrieved:
         return "No sources found."
 
-    top = retrieved[:5]
-    parts = []
-    for i, r in enumerate(top, start=1):
-        snippet = (r.get("snippet") or r.get("text") or "").strip()
-        if snippet:
-            parts.append(f"{snippet} [{i}]")
-
-    if not parts:
+    # (source index, snippet) for the top hits that have any text, built once
+    snips = [
+        (i, s)
+        for i, s in enumerate(
+            ((r.get("snippet") or r.get("text") or "").strip() for r in retrieved[:5]),
+            start=1,
+        )
+        if s
+    ]
+    if not snips:
         return "No useful snippets found in sources."
 
     q_lower = (question or "").strip().lower()
@@ -146,83 +167,44 @@ def deterministic_synthesis(question: str, retrieved: list[dict]) -> str:
         q_lower.startswith("как ") or q_lower.startswith("каким образом ")
         or "шаг" in q_lower or "инструкц" in q_lower
     )
-    if is_howto:
-        snips: list[tuple[int, str]] = []
-        for idx, r in enumerate(top, start=1):
-            s = (r.get("snippet") or r.get("text") or "").strip()
-            if s:
-                snips.append((idx, s))
-        if not snips:
-            return " ".join(parts)
-        first = snips[0][1]
-        dot = first.find(". ", 10)
-        if dot > 0:
-            answer_sent = first[: dot + 1].strip()
-        else:
-            words = first.split()
-            answer_sent = " ".join(words[:25]) + ("..." if len(words) > 25 else "")
-        detail_bullets = []
-        for src_i, s in snips[:5]:
-            if ":" in s:
-                colon_pos = s.find(":")
-                after = s[colon_pos + 1 :].strip()
-                items = [x.strip() for x in after.split(",") if x.strip()]
-                if len(items) >= 2:
-                    take = min(5, len(items))
-                    for item in items[:take]:
-                        item = (item or "").rstrip(" .;")
-                        if item:
-                            detail_bullets.append(f"- {item} [{src_i}]")
-                    continue
-            step = (s[:80] + "..." if len(s) > 80 else s).strip()
-            if step:
-                detail_bullets.append(f"- {step} [{src_i}]")
-        if len(detail_bullets) > 5:
-            detail_bullets = detail_bullets[:5]
-        source_bullets = []
-        for src_i, s in snips[:3]:
-            short = " ".join(s.split()[:25])
-            if len(s.split()) > 25:
-                short += "..."
-            if short:
-                source_bullets.append(f"- {short} [{src_i}]")
-        lines = [
-            f"Ответ: {answer_sent}",
-            "",
-            "Детали:",
-            *detail_bullets,
-            "",
-            "Источники:",
-            *source_bullets,
-        ]
-        non_empty = [ln for ln in lines if ln.strip()]
-        while len(non_empty) > 14 and detail_bullets:
-            detail_bullets.pop()
-            lines = [
-                f"Ответ: {answer_sent}",
-                "",
-                "Детали:",
-                *detail_bullets,
-                "",
-                "Источники:",
-                *source_bullets,
-            ]
-            non_empty = [ln for ln in lines if ln.strip()]
-        if len(non_empty) > 14 and source_bullets:
-            source_bullets.pop()
-            lines = [
-                f"Ответ: {answer_sent}",
-                "",
-                "Детали:",
-                *detail_bullets,
-                "",
-                "Источники:",
-                *source_bullets,
-            ]
-            non_empty = [ln for ln in lines if ln.strip()]
-        return "\n".join(lines)
-
-    return " ".join(parts)
+    if not is_howto:
+        return " ".join(f"{s} [{i}]" for i, s in snips)
+
+    first = snips[0][1]
+    dot = first.find(". ", 10)
+    if dot > 0:
+        answer_sent = first[: dot + 1].strip()
+    else:
+        words = first.split()
+        answer_sent = " ".join(words[:25]) + ("..." if len(words) > 25 else "")
+    detail_bullets = []
+    for src_i, s in snips:
+        if ":" in s:
+            after = s[s.find(":") + 1 :].strip()
+            items = [x.strip() for x in after.split(",") if x.strip()]
+            if len(items) >= 2:
+                for item in items[:5]:
+                    item = item.rstrip(" .;")
+                    if item:
+                        detail_bullets.append(f"- {item} [{src_i}]")
+                continue
+        step = (s[:80] + "..." if len(s) > 80 else s).strip()
+        if step:
+            detail_bullets.append(f"- {step} [{src_i}]")
+    source_bullets = []
+    for src_i, s in snips[:3]:
+        words = s.split()
+        source_bullets.append(f"- {' '.join(words[:25])}{'...' if len(words) > 25 else ''} [{src_i}]")
+    # at most 3 headers + 5 details + 3 sources: always within the 14-line budget
+    return "\n".join([
+        f"Ответ: {answer_sent}",
+        "",
+        "Детали:",
+        *detail_bullets[:5],
+        "",
+        "Источники:",
+        *source_bullets,
+    ])
 
 
 def _has_first_person_intro(chunks: list[dict] | None) -> bool:
@@ -246,45 +228,67 @@ def _is_doc_title_question(question: str) -> bool:
 
 
 
+# Hashed fields per request kind, pre-sorted: the canonical JSON is emitted in
+# this order, so no key sort is needed (bytes match the old sort_keys=True form).
+_UPLOAD_HASH_KEYS = ("actor_id", "content", "mode", "text", "title", "workspace_id")
+_ASK_HASH_KEYS = ("answer_mode", "document_id", "mode", "question", "retriever", "top_k")
+
+def _json_canon_dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def _canon_dumps(obj) -> bytes:
+    # byte-identical to _json_canon_dumps for str/int/None payloads (stored hashes stay valid)
+    try:
+        return orjson.dumps(obj)
+    except TypeError:  # orjson.JSONEncodeError: e.g. ints wider than 64 bits
+        return _json_canon_dumps(obj)
+
+
 def request_hash(payload: dict) -> str:
     """Hash request payload for idempotency safety (must include all behavior-changing fields)."""
-    import json
-
     mode = payload.get("mode")
 
     # Support both:
     # - ask(): question/retriever/top_k/document_id/answer_mode
     # - kb_upload_text(): title/content (legacy 'text' too)
     if mode == "kb_upload_text" or payload.get("content") is not None or payload.get("text") is not None:
-        stable = {
-            "mode": mode or "kb_upload_text",
-            "workspace_id": payload.get("workspace_id"),
-            "actor_id": payload.get("actor_id"),
-            "title": payload.get("title"),
-            "content": payload.get("content"),
-            "text": payload.get("text"),
-        }
+        stable = {k: payload.get(k) for k in _UPLOAD_HASH_KEYS}
+        stable["mode"] = mode or "kb_upload_text"
     else:
-        stable = {
-            "mode": payload.get("mode"),
-            "question": payload.get("question"),
-            "retriever": payload.get("retriever"),
-            "top_k": payload.get("top_k"),
-            "document_id": payload.get("document_id"),
-            "answer_mode": payload.get("answer_mode"),
-        }
+        stable = {k: payload.get(k) for k in _ASK_HASH_KEYS}
+
+    return hashlib.sha256(_canon_dumps(stable)).hexdigest()
 
-    blob = json.dumps(stable, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
-    return hashlib.sha256(blob).hexdigest()
 
+# Process-local cache of default row ids: the default workspace/upload source
+# never change once created, so get_or_create runs once per worker.
+_DEFAULTS: dict = {}
+_DEFAULTS_LOCK = threading.Lock()
 
-def get_or_create_default_workspace() -> Workspace:
-    ws, _ = Workspace.objects.get_or_create(name="default")
-    return ws
 
-def get_or_create_upload_source(ws: Workspace) -> KnowledgeSource:
-    src, _ = KnowledgeSource.objects.get_or_create(workspace=ws, kind="upload", name="uploads")
-    return src
+def default_workspace_id() -> int:
+    ws_id = _DEFAULTS.get("workspace_id")
+    if ws_id is None:
+        with _DEFAULTS_LOCK:
+            ws_id = _DEFAULTS.get("workspace_id")
+            if ws_id is None:
+                ws, _ = Workspace.objects.get_or_create(name="default")
+                ws_id = _DEFAULTS["workspace_id"] = ws.id
+    return ws_id
+
+
+def upload_source_id(ws_id: int) -> int:
+    key = ("upload_source_id", ws_id)
+    src_id = _DEFAULTS.get(key)
+    if src_id is None:
+        with _DEFAULTS_LOCK:
+            src_id = _DEFAULTS.get(key)
+            if src_id is None:
+                src, _ = KnowledgeSource.objects.get_or_create(workspace_id=ws_id, kind="upload", name="uploads")
+                src_id = _DEFAULTS[key] = src.id
+    return src_id
+
 
 # --------------------
 # KB endpoints
@@ -296,55 +300,34 @@ def kb_upload_text(request):
 
     ser = UploadTextSerializer(data=data)
     if not ser.is_valid():
-        err = ser.errors
-        msg = None
-
-        if isinstance(err, dict):
-            # prefer our custom shape first
-            if "error" in err:
-                msg = err["error"]
-                if isinstance(msg, list) and msg:
-                    msg = msg[0]
-            # DRF common shapes
-            elif "non_field_errors" in err:
-                msg = err["non_field_errors"]
-                if isinstance(msg, list) and msg:
-                    msg = msg[0]
-            elif "content" in err:
-                msg = err["content"]
-                if isinstance(msg, list) and msg:
-                    msg = msg[0]
-            elif "text" in err:
-                msg = err["text"]
-                if isinstance(msg, list) and msg:
-                    msg = msg[0]
-
-        if not msg:
-            msg = "content is required"
-
+        msg = first_error_message(ser.errors, UPLOAD_ERROR_KEYS) or "content is required"
         return Response({"detail": {"error": msg}}, status=400)
 
     title = (ser.validated_data.get("title") or "").strip()
     content = (ser.validated_data.get("content") or "").strip()
     title_for_hash = title
 
-    ws = get_or_create_default_workspace()
+    ws_id = default_workspace_id()
 
     # --- Idempotency: same key + same request_hash => replay stored response_json
-    raw_key = request.headers.get("Idempotency-Key") or request.headers.get("X-Idempotency-Key") or request.META.get("HTTP_IDEMPOTENCY_KEY") or request.META.get("HTTP_X_IDEMPOTENCY_KEY")
-    idem_key = normalize_idempotency_key(raw_key) if raw_key else None
-
-    payload_for_idem = {
-        "mode": "kb_upload_text",
-        "workspace_id": ws.id,
-        "actor_id": (request.user.id if getattr(request.user, "is_authenticated", False) else None),
-        "title": title_for_hash,
-        "content": content,
-    }
-    r_hash = request_hash(payload_for_idem)
+    idem_key = idempotency_key_from_request(request)
 
+    # the hash serializes the whole upload: only pay for it when a key is supplied
+    r_hash = ""
     if idem_key:
-        existing = IdempotencyKey.objects.filter(key=idem_key).first()
+        r_hash = request_hash({
+            "mode": "kb_upload_text",
+            "workspace_id": ws_id,
+            "actor_id": (request.user.id if getattr(request.user, "is_authenticated", False) else None),
+            "title": title_for_hash,
+            "content": content,
+        })
+
+    if idem_key:
+        cached = get_idempotent_replay(idem_key, r_hash)
+        if cached is not None:
+            return cached
+        existing = IdempotencyKey.objects.filter(key=idem_key).only("request_hash", "response_json").first()
         if existing:
             if (existing.request_hash or "") != r_hash:
                 return Response(
@@ -352,6 +335,7 @@ def kb_upload_text(request):
                     status=409,
                 )
             if existing.response_json is not None:
+                set_idempotent_replay(idem_key, r_hash, existing.response_json)
                 return Response(existing.response_json, status=200)
             # fallback: stable response if record exists but response_json missing
             return Response({"detail": {"error": "idempotent replay missing stored response"}}, status=200)
@@ -360,32 +344,37 @@ def kb_upload_text(request):
     if not title:
         title = f"Text Upload #{uuid.uuid4().hex[:8]}"
 
-    src = get_or_create_upload_source(ws)
-    doc = Document.objects.create(
-        workspace=ws,
-        source=src,
-        title=title,
-        filename="",
-        mime="text/plain",
-        content=content,
-        content_hash=sha256_text(content),
-        status="uploaded",
-    )
-    process_document.delay(doc.id)
-
-    resp = {"document_id": doc.id, "status": "uploaded", "queued": True}
-
-    if idem_key:
-        IdempotencyKey.objects.update_or_create(
-            key=idem_key,
-            defaults={"workspace": ws, "request_hash": r_hash, "run": None, "response_json": resp},
+    with transaction.atomic():
+        doc = Document.objects.create(
+            workspace_id=ws_id,
+            source_id=upload_source_id(ws_id),
+            title=title,
+            filename="",
+            mime="text/plain",
+            content=content,
+            content_hash=sha256_text(content),
+            status="uploaded",
         )
+        resp = {"document_id": doc.id, "status": "uploaded", "queued": True}
+
+        if idem_key:
+            upsert_idempotency_key(
+                IdempotencyKey(key=idem_key, workspace_id=ws_id, request_hash=r_hash, run=None, response_json=resp),
+                update_fields=("workspace", "request_hash", "run", "response_json"),
+            )
+            transaction.on_commit(lambda: set_idempotent_replay(idem_key, r_hash, resp))
+        # enqueue only once the row is committed (worker never sees a missing doc)
+        transaction.on_commit(lambda: process_document.delay(doc.id))
 
     return Response(resp, status=status.HTTP_201_CREATED)
 
 
 
 
+# path separators in client filenames -> "_" (one C-level pass)
+_UPLOAD_NAME_TRANS = str.maketrans({"/": "_", "\\": "_"})
+
+
 @api_view(["POST"])
 @parser_classes([MultiPartParser, FormParser])
 def kb_upload_file(request):
@@ -398,8 +387,7 @@ def kb_upload_file(request):
       - PDF: pypdf first, then pdfminer.six fallback
       - non-PDF: utf-8 decode (best-effort)
     """
-    ws = get_or_create_default_workspace()
-    src = get_or_create_upload_source(ws)
+    ws_id = default_workspace_id()
 
     upload = request.FILES.get("file")
     if upload is None:
@@ -409,91 +397,100 @@ def kb_upload_file(request):
     filename = upload.name or ""
     mime = getattr(upload, "content_type", "") or ""
 
-    from django.conf import settings
-    from pathlib import Path as _Path
-
-    ws_dir = _Path(settings.MEDIA_ROOT) / f"ws_{ws.id}"
+    ws_dir = Path(settings.MEDIA_ROOT) / f"ws_{ws_id}"
     ws_dir.mkdir(parents=True, exist_ok=True)
 
-    safe_name = (filename or "upload").replace("/", "_").replace("\\", "_")
+    safe_name = (filename or "upload").translate(_UPLOAD_NAME_TRANS)
     file_path = ws_dir / safe_name
 
+    lower = safe_name.lower()
+    is_pdf = lower.endswith(".pdf") or mime == "application/pdf"
+
+    # Write to disk and decode text in the same pass over upload.chunks(), so the
+    # file is never read back. PDFs: worker extracts via pdfminer in process_document.
+    decoder = None if is_pdf else codecs.getincrementaldecoder("utf-8")(errors="replace")
+    parts = []
     with open(file_path, "wb") as f:
         for chunk in upload.chunks():
             f.write(chunk)
+            if decoder is not None:
+                parts.append(decoder.decode(chunk))
+    if decoder is not None:
+        parts.append(decoder.decode(b"", final=True))
 
-    lower = safe_name.lower()
-
-    # --- extract text (PDF: worker extracts via pdfminer in process_document) ---
-    text = ""
-    if lower.endswith(".pdf") or mime == "application/pdf":
-        # Leave content empty; worker will extract via pdfminer in process_document
-        pass
-    else:
-        try:
-            data = file_path.read_bytes()
-            text = data.decode("utf-8", errors="replace").strip()
-        except Exception as e:
-            return Response({"detail": {"error": "failed to read file: " + e.__class__.__name__ + ": " + str(e)}}, status=400)
-
-    text = (text or "").replace("\x00", "")
-    is_pdf = lower.endswith(".pdf") or mime == "application/pdf"
+    text = "".join(parts).strip().replace("\x00", "")
     if not text and not is_pdf:
         return Response({"detail": {"error": "extracted text is empty"}}, status=400)
 
     # persist doc + enqueue embedding
     content_hash = sha256_text(text)
-    doc = Document.objects.create(
-        workspace=ws,
-        source=src,
-        title=title,
-        filename=filename,
-        mime=(mime or ("application/pdf" if lower.endswith(".pdf") else "application/octet-stream")),
-        file_path=str(file_path),
-        content=text,
-        content_hash=content_hash,
-        status="uploaded",
-    )
-    process_document.delay(doc.id)
+    with transaction.atomic():
+        doc = Document.objects.create(
+            workspace_id=ws_id,
+            source_id=upload_source_id(ws_id),
+            title=title,
+            filename=filename,
+            mime=(mime or ("application/pdf" if lower.endswith(".pdf") else "application/octet-stream")),
+            file_path=str(file_path),
+            content=text,
+            content_hash=content_hash,
+            status="uploaded",
+        )
+        transaction.on_commit(lambda: process_document.delay(doc.id))
     return Response({"document_id": doc.id, "status": doc.status, "queued": True}, status=201)
 
+def _limit_offset(request, default: int = 50, max_limit: int = 200) -> tuple:
+    """Parse ?limit=&offset= for list endpoints (clamped; bad values -> defaults)."""
+    try:
+        limit = int(request.GET.get("limit", default))
+    except (TypeError, ValueError):
+        limit = default
+    try:
+        offset = int(request.GET.get("offset", 0))
+    except (TypeError, ValueError):
+        offset = 0
+    return max(1, min(limit, max_limit)), max(0, offset)
+
+
 @api_view(["GET"])
 def kb_documents(request):
-    ws = get_or_create_default_workspace()
-    qs = Document.objects.filter(workspace=ws).order_by("-id")[:50]
-    return Response(DocumentSerializer(qs, many=True).data)
+    ws_id = default_workspace_id()
+    limit, offset = _limit_offset(request)
+    key = f"kb_documents:{ws_id}:{limit}:{offset}"
+    rows = cache_get(key)
+    if rows is None:
+        qs = Document.objects.filter(workspace_id=ws_id).order_by("-id")[offset:offset + limit]
+        rows = document_rows(qs)
+        cache_set(key, rows, LIST_TTL)
+    return Response(rows)
 
 @api_view(["GET"])
 def kb_document_detail(request, document_id: int):
-    ws = get_or_create_default_workspace()
-    doc = Document.objects.get(workspace=ws, id=document_id)
-    return Response({
-        "id": doc.id,
-        "title": doc.title,
-        "status": doc.status,
-        "chunk_count": doc.chunk_count,
-        "created_at": doc.created_at,
-        "content_preview": doc.content[:500],
-    })
+    ws_id = default_workspace_id()
+    # preview is cut in SQL: the full content never leaves Postgres
+    doc = get_object_or_404(
+        Document.objects.annotate(content_preview=Substr("content", 1, 500)).values(
+            "id", "title", "status", "chunk_count", "created_at", "content_preview",
+        ),
+        workspace_id=ws_id,
+        pk=document_id,
+    )
+    return Response(doc)
 
 # --------------------
 # Copilot "ask" (MVP without LLM) + Idempotency v2
 # --------------------
 
-def build_answer_from_retrieved(retrieved):
-    lines = ["Found relevant context in KB:"]
-    for i, r in enumerate(retrieved or [], start=1):
-        title = (r or {}).get("document_title", "")
-        snip = ((r or {}).get("snippet", "") or "").strip()
-        lines.append(f"{i}. [{title}] {snip}")
-    return "\n\n".join(lines)
-
 def sanitize_sources(items):
-    """Copy each source dict and remove full chunk text to avoid leaking in API/DB."""
-    out = [dict(r or {}) for r in (items or [])]
-    for d in out:
-        d.pop("text", None)
-    return out
+    """Source dicts without the full chunk text (never leaked to API/DB).
+
+    Dicts carrying "text" are copied without it in one pass; dicts that have no
+    "text" are passed through as-is. Callers' dicts are never mutated.
+    """
+    return [
+        {k: v for k, v in r.items() if k != "text"} if "text" in r else r
+        for r in ((x or {}) for x in (items or []))
+    ]
 
 
 def _add_out_of_doc_notice(notice: str, document_id: Optional[int]) -> str:
@@ -507,18 +504,19 @@ def _wants_list(question: str) -> bool:
     return any(k in q for k in ("список", "списком", "перечисл", "перечень", "пункт", "буллет", "bullet"))
 
 
+_INLINE_CITATION_RE = re.compile(r"\s*\[\d+\]\s*")
+_CITATION_INDEX_RE = re.compile(r"\[(\d+)\]")
+_SPACE_BEFORE_PUNCT_RE = re.compile(r"\s+([.,!?;:])")
+_MULTI_SPACE_RE = re.compile(r"\s{2,}")
+
+
 def _strip_inline_citations(s: str) -> str:
-    return re.sub(r"\s*\[\d+\]\s*", " ", (s or "")).strip()
+    return _INLINE_CITATION_RE.sub(" ", (s or "")).strip()
 
 
 def _extract_cited_indices(text: str) -> set:
-    cited = set()
-    for m in re.findall(r"\[(\d+)\]", text or ""):
-        try:
-            cited.add(int(m))
-        except Exception:
-            continue
-    return cited
+    # the pattern only captures digits, so int() can't fail
+    return {int(m) for m in _CITATION_INDEX_RE.findall(text or "")}
 
 
 def _filter_sources_by_citations(answer_with_citations: str, sources: list, max_items: int = 3) -> list:
@@ -534,27 +532,6 @@ def _filter_sources_by_citations(answer_with_citations: str, sources: list, max_
     return srcs[:max_items]
 
 
-def _trim_doc_answer_sections(structured_text: str) -> str:
-    """Keep only the answer block; drop Quotes/Цитаты and Sources/Источники sections."""
-    t = (structured_text or "").strip()
-    if not t:
-        return ""
-    stop_heads = (
-        "источники:",
-        "sources:",
-        "источник:",
-        "source:",
-        "цитаты:",
-        "quotes:",
-    )
-    kept = []
-    for raw in t.splitlines():
-        line = (raw or "").strip()
-        if line and any(line.lower().startswith(h) for h in stop_heads):
-            break
-        kept.append(raw)
-    return "\n".join(kept).strip()
-
 def _format_doc_answer(question: str, structured_text: str, max_lines: int = 2) -> str:
     """UX contract for doc_rag: 1–2 lines, strictly from document, NO headings, no inline [n] in answer."""
     t = (structured_text or "").strip()
@@ -609,9 +586,9 @@ def _format_doc_answer(question: str, structured_text: str, max_lines: int = 2)
     for ln in lines:
         ln = (ln or "").strip()
         # Fix common spacing artifacts before punctuation (e.g., "Arina ." / "Арина .")
-        ln = re.sub(r"\s+([.,!?;:])", r"\1", ln)
+        ln = _SPACE_BEFORE_PUNCT_RE.sub(r"\1", ln)
         # Also normalize multiple spaces just in case
-        ln = re.sub(r"\s{2,}", " ", ln).strip()
+        ln = _MULTI_SPACE_RE.sub(" ", ln).strip()
         if ln:
             out.append(ln)
         if len(out) >= max_lines:
@@ -619,158 +596,61 @@ def _format_doc_answer(question: str, structured_text: str, max_lines: int = 2)
     return "\n".join(out).strip()
 
 
+REPLAY_STEP_NAMES = ("retrieve_context", "generate_answer")
+
+
+def _latest_step(run: AgentRun, name: str):
+    """Newest step with this name; served from run.replay_steps when preloaded."""
+    steps = getattr(run, "replay_steps", None)
+    if steps is None:
+        return run.steps.filter(name=name).order_by("-id").first()
+    return next((st for st in steps if st.name == name), None)
+
+
 def get_sources_from_run(run: AgentRun):
-    step = run.steps.filter(name="retrieve_context").order_by("-id").first()
+    step = _latest_step(run, "retrieve_context")
     if not step:
         return []
     out = step.output_json or {}
     return sanitize_sources(out.get("results", []) or [])
 
 
-# --------------------
-# Language helpers (minimal, no deps)
-# --------------------
-CYRILLIC_RE = re.compile(r"[А-Яа-яЁё]")
-
-
-def _detect_lang(text: Optional[str]) -> str:
-    """Return 'ru' if text contains Cyrillic, else 'en'."""
-    return "ru" if text and CYRILLIC_RE.search(text) else "en"
-
-
 def _general_answer_deterministic(question: str) -> str:
     q = " ".join((question or "").strip().split())
-    lang = _detect_lang(q)
+    lang = detect_lang(q)
     if lang == "ru":
         return f"В документе нет информации по вопросу: {q}."
     return f"This document does not contain information about {q}."
 
 
-def _validate_and_repair_fallback(question: str, draft: str) -> str:
-    """Validate fallback answer; if invalid, call repair_fallback_openai and return repaired answer."""
-    q = (question or "").strip()
-    d = (draft or "").strip()
-    if not d:
-        return draft
-    # IMPORTANT: repair_fallback_openai is RU-only today (llm.py), so for EN questions
-    # we must NOT enforce RU templates or call RU repair. Formatting is handled in ensure_general_sections().
-    if _detect_lang(question) == "en":
-        return draft
-    expected_legacy = "В данном документе нет информации, чтобы ответить на: " + q + "."
-    first_line = (d.split("\n")[0] or "").strip()
-    if first_line != expected_legacy and not first_line.startswith("В этом документе нет информации о том,"):
-        out = repair_fallback_openai(question, draft)
-        return (out.get("answer") or "").strip() or draft
-    if "В данном документе нет прямого ответа" in d:
-        out = repair_fallback_openai(question, draft)
-        return (out.get("answer") or "").strip() or draft
-    d_lower = d.lower()
-    for w in ("возможно", "может быть", "возможен", "иногда"):
-        if w in d_lower:
-            out = repair_fallback_openai(question, draft)
-            return (out.get("answer") or "").strip() or draft
-    q_lower = q.lower()
-    if "главн" in q_lower and any(x in q_lower for x in ("героин", "герой", "персонаж")):
-        for m in ("болезн", "расстройств", "зависим", "диагноз", "псих", "мед"):
-            if m in d_lower:
-                out = repair_fallback_openai(question, draft)
-                return (out.get("answer") or "").strip() or draft
-    lines = [l for l in d.splitlines() if l.strip()]
-    if len(lines) > 14:
-        out = repair_fallback_openai(question, draft)
-        return (out.get("answer") or "").strip() or draft
-    return draft
-
-
-def _build_doc_context(retrieved: list) -> str:
-    """Build context string exactly like rag_answer_openai for retrieved snippets."""
-    retrieved = (retrieved or [])[:5]
-    ctx_lines = []
-    for i, r in enumerate(retrieved, start=1):
-        title = (r or {}).get("document_title", "")
-        block = ((r or {}).get("text") or (r or {}).get("snippet") or "").strip()
-        block = block[:3500]
-        ctx_lines.append(f"[{i}] {title}\n{block}")
-    return "\n\n".join(ctx_lines).strip()
-
-
-def _trim_answer_line_citations(text: str) -> str:
-    """In the first line starting with 'Ответ:', keep only the first two citation markers [n]."""
-    if not (text or "").strip():
-        return text or ""
-    lines = text.split("\n")
-    for i, line in enumerate(lines):
-        if line.strip().startswith("Ответ:"):
-            matches = list(re.finditer(r"\[\d+\]", line))
-            if len(matches) >= 3:
-                for m in reversed(matches[2:]):
-                    line = line[: m.start()] + line[m.end() :]
-                lines[i] = line
-            break
-    return "\n".join(lines)
-
-
-def ensure_doc_sections(answer_text: str, retrieved: list) -> str:
-    """If answer has Ответ/Детали/Источники or Answer/Sources (EN) return as-is; else build structured text from retrieved."""
-    if not (answer_text or "").strip() or not retrieved:
-        return answer_text or ""
-    t = (answer_text or "").strip()
-    if "Ответ:" in t and "Детали:" in t and "Источники:" in t:
-        return answer_text
-    if "Answer:" in t and "Sources:" in t:
-        return answer_text
-    top = (retrieved or [])[:5]
-    if any(((r or {}).get("snippet") or (r or {}).get("text") or "").strip().startswith("Шаг ") for r in top):
-        top = sorted(top, key=lambda r: int(r.get("chunk_index", 0)) if isinstance(r.get("chunk_index"), (int, float)) else 0)
-    snips = []
-    for idx, r in enumerate(top, start=1):
-        s = (r.get("snippet") or r.get("text") or "").strip()
-        if s:
-            snips.append((idx, s))
-    if not snips:
-        return answer_text or ""
-    first = snips[0][1]
-    dot = first.find(". ", 10)
-    if dot > 0:
-        answer_sent = first[: dot + 1].strip()
-    else:
-        words = first.split()
-        answer_sent = " ".join(words[:25]) + ("..." if len(words) > 25 else "")
-    detail_bullets = []
-    for src_i, s in snips[:5]:
-        if ":" in s:
-            colon_pos = s.find(":")
-            after = s[colon_pos + 1 :].strip()
-            items = [x.strip() for x in after.split(",") if x.strip()]
-            if len(items) >= 2:
-                take = min(5, len(items))
-                for item in items[:take]:
-                    item = (item or "").rstrip(" .;")
-                    if item:
-                        detail_bullets.append(f"- {item} [{src_i}]")
-                continue
-        step = (s[:80] + "..." if len(s) > 80 else s).strip()
-        if step:
-            detail_bullets.append(f"- {step} [{src_i}]")
-    if len(detail_bullets) > 5:
-        detail_bullets = detail_bullets[:5]
-    source_bullets = []
-    for src_i, s in snips[:3]:
-        short = " ".join(s.split()[:25])
-        if len(s.split()) > 25:
-            short += "..."
-        if short:
-            source_bullets.append(f"- {short} [{src_i}]")
-    lines = [f"Ответ: {answer_sent}", "", "Детали:", *detail_bullets, "", "Источники:", *source_bullets]
-    non_empty = [ln for ln in lines if ln.strip()]
-    while len(non_empty) > 14 and detail_bullets:
-        detail_bullets.pop()
-        lines = [f"Ответ: {answer_sent}", "", "Детали:", *detail_bullets, "", "Источники:", *source_bullets]
-        non_empty = [ln for ln in lines if ln.strip()]
-    if len(non_empty) > 14 and source_bullets:
-        source_bullets.pop()
-        lines = [f"Ответ: {answer_sent}", "", "Детали:", *detail_bullets, "", "Источники:", *source_bullets]
-    return "\n".join(lines)
+# Legacy "no-doc" wrapper around general answers (older prompts / stored runs)
+_GENERAL_HINT_RU = "Если вам нужен ответ именно по документу, задайте вопрос о конкретном фрагменте или загрузите текст, где эта тема упоминается."
+_GENERAL_HINT_EN = "If you need an answer from the document, ask about a specific fragment or upload a text where this topic appears."
+_GENERAL_HEADER_RU = "Общий ответ вне документа:"
+_GENERAL_HEADER_EN = "General answer (outside the document):"
+
+# wrapper lines dropped by ensure_general_sections: one str.startswith(tuple) call per line
+_LEGACY_GENERAL_LINE_PREFIXES = (
+    # disclaimers
+    "В этом документе нет информации",
+    "This document does not contain information",
+    # wrapper headers
+    _GENERAL_HEADER_RU,
+    _GENERAL_HEADER_EN,
+    # legacy headings
+    "Проверка по документу:",
+    "Что именно отсутствует:",
+    "Общий ответ (не из документа):",
+    "Как получить точный ответ по документу:",
+    # legacy bullet noise
+    "- В документе нет достаточных фрагментов",
+    "- Уточните формулировку",
+    "- Можно переформулировать",
+    "- Найдите в документе фрагмент",
+    "- Задайте вопрос по конкретному месту",
+    "- Нет релевантных фрагментов",
+    "Это общий ответ, не из документа",
+)
 
 
 def ensure_general_sections(question: str, answer_text: str) -> str:
@@ -779,148 +659,54 @@ def ensure_general_sections(question: str, answer_text: str) -> str:
         return answer_text or ""
 
     t = (answer_text or "").strip()
-    lang = _detect_lang(question)
-
-    # Define legacy wrapper markers
-    hint_ru = "Если вам нужен ответ именно по документу, задайте вопрос о конкретном фрагменте или загрузите текст, где эта тема упоминается."
-    hint_en = "If you need an answer from the document, ask about a specific fragment or upload a text where this topic appears."
-    header_ru = "Общий ответ вне документа:"
-    header_en = "General answer (outside the document):"
-
-    # Detect legacy wrapper markers
-    has_ru_marker = header_ru in t or hint_ru in t
-    has_en_marker = header_en in t or hint_en in t
-    has_legacy_marker = has_ru_marker or has_en_marker
 
     # If NO legacy marker present: return unchanged (preserves deterministic one-liners)
-    if not has_legacy_marker:
+    if not (
+        _GENERAL_HEADER_RU in t or _GENERAL_HINT_RU in t
+        or _GENERAL_HEADER_EN in t or _GENERAL_HINT_EN in t
+    ):
         return t
 
-    # Legacy marker present: strip wrapper parts
-    lines = [ln.strip() for ln in t.splitlines() if (ln or "").strip()]
+    # Legacy marker present: strip wrapper parts (disclaimers, headers, hints, legacy headings/bullets)
     cleaned_lines = []
-    legacy_heads = (
-        "Проверка по документу:",
-        "Что именно отсутствует:",
-        "Общий ответ (не из документа):",
-        "Как получить точный ответ по документу:",
-    )
-
-    for ln in lines:
-        # Skip disclaimer lines
-        if ln.startswith("В этом документе нет информации") or ln.startswith("This document does not contain information"):
-            continue
-        # Skip wrapper headers
-        if ln == header_ru or ln == header_en or ln.startswith(header_ru) or ln.startswith(header_en):
-            continue
-        # Skip hint lines
-        if ln == hint_ru or ln == hint_en:
-            continue
-        # Skip legacy headings
-        if any(ln.startswith(h) for h in legacy_heads):
-            continue
-        # Skip legacy bullet noise
-        if ln.startswith("- В документе нет достаточных фрагментов"):
-            continue
-        if ln.startswith("- Уточните формулировку"):
+    for ln in t.splitlines():
+        ln = ln.strip()
+        if not ln or ln == _GENERAL_HINT_RU or ln == _GENERAL_HINT_EN:
             continue
-        if ln.startswith("- Можно переформулировать"):
-            continue
-        if ln.startswith("- Найдите в документе фрагмент"):
-            continue
-        if ln.startswith("- Задайте вопрос по конкретному месту"):
-            continue
-        if ln.startswith("- Нет релевантных фрагментов"):
-            continue
-        if ln.startswith("Это общий ответ, не из документа"):
+        if ln.startswith(_LEGACY_GENERAL_LINE_PREFIXES):
             continue
         cleaned_lines.append(ln)
+        if len(cleaned_lines) == 10:  # limit to ~10 lines
+            break
 
-    # Limit to ~10 lines
-    cleaned_lines = cleaned_lines[:10]
     result = "\n".join(cleaned_lines).strip()
 
     # Fallback if nothing remains
     if not result:
-        return "Не знаю." if lang == "ru" else "I don't know."
+        return "Не знаю." if detect_lang(question) == "ru" else "I don't know."
 
     return result
 
 
-def _validate_and_repair_doc_answer(question: str, retrieved: list, draft: str) -> tuple:
-    """Validate doc answer format; if invalid, call repair_doc_answer_openai. Language-aware: EN uses Answer/Sources (optional Quotes), RU uses Ответ/Источники (optional Цитаты). Returns (answer_str, llm_used_if_repaired_or_None)."""
-    d = (draft or "").strip()
-    if not d:
-        return (draft, None)
-    lang = detect_lang(question)
-    if lang == "en":
-        has_answer = "Answer:" in d
-        has_sources = "Sources:" in d
-        if not has_answer or not has_sources:
-            try:
-                context = _build_doc_context(retrieved)
-                out = repair_doc_answer_openai(question, context, draft)
-                return ((out.get("answer") or "").strip() or draft, out.get("llm_used"))
-            except Exception:
-                return (draft, None)
-        return (draft, None)
-    # RU: require Ответ: and Источники: (optional Цитаты:). Do not require Детали:.
-    if "Ответ:" not in d or "Источники:" not in d:
-        try:
-            context = _build_doc_context(retrieved)
-            out = repair_doc_answer_openai(question, context, draft)
-            return ((out.get("answer") or "").strip() or draft, out.get("llm_used"))
-        except Exception:
-            return (draft, None)
-    return (draft, None)
-
-
-def normalize_source(r: dict) -> dict:
-    # normalize payload so sources in replay == sources in normal response
-    if not isinstance(r, dict):
-        return {}
-    return {
-        "document_id": r.get("document_id"),
-        "document_title": r.get("document_title"),
-        "chunk_id": r.get("chunk_id"),
-        "chunk_index": r.get("chunk_index"),
-        "matched_terms": r.get("matched_terms", []),
-        "distance": r.get("distance"),
-        "score": r.get("score"),
-        "snippet": r.get("snippet"),
-        "retriever_hint": r.get("retriever_hint"),
-        "vector_score": r.get("vector_score"),
-        "keyword_bonus": r.get("keyword_bonus"),
-        "keyword_score": r.get("keyword_score"),
-        "keyword_norm": r.get("keyword_norm"),
-        "final_score": r.get("final_score"),
-    }
+# Document-scoped questions asking for an overview take the summary route
+SUMMARY_TRIGGERS_RE = re.compile(
+    "о чем|про что|кратко|краткое содержание|summary|summarize|обзор|суть|главное|основная мысль|идея|выжимка"
+)
+
+
+def _finish_run(run: AgentRun, steps: list, fields=("status", "final_output")) -> None:
+    """Persist the run result and its trace steps together: one transaction, one INSERT for all steps."""
+    with transaction.atomic():
+        run.save(update_fields=list(fields))
+        AgentStep.objects.bulk_create(steps)
+
 
 @api_view(["POST"])
 def ask(request):
-    ser = AskSerializer(data=request.data)
-    try:
-        ser.is_valid(raise_exception=True)
-    except Exception as e:
-        # normalize DRF ValidationError -> {"detail": {"error": "..."}}
-        err = getattr(e, "detail", None)
-        msg = None
-        if isinstance(err, dict):
-            # typical shapes: {"field": ["..."]} or {"non_field_errors": ["..."]}
-            if "non_field_errors" in err:
-                msg = err.get("non_field_errors")
-            else:
-                # take first field error
-                for _k, _v in err.items():
-                    msg = _v
-                    break
-            if isinstance(msg, list) and msg:
-                msg = msg[0]
-        elif isinstance(err, list) and err:
-            msg = err[0]
-        if not msg:
-            msg = "invalid request"
-        _m = str(msg)
+    validated, err_msg = validate_ask(request.data)
+    if validated is None:
+        # normalize validation errors -> {"detail": {"error": "..."}}
+        _m = str(err_msg or "invalid request")
         # optional: make a couple messages friendlier/stable
         if _m == "This field is required.":
             _m = "question is required"
@@ -928,14 +714,14 @@ def ask(request):
             _m = "question may not be blank"
         return Response({"detail": {"error": _m}}, status=400)
 
-    question = ser.validated_data["question"]
-    mode = ser.validated_data.get("mode", "answer")
-    retriever = ser.validated_data.get("retriever", "auto")
-    top_k = int(ser.validated_data.get("top_k", 5) or 5)
-    document_id = ser.validated_data.get("document_id")
+    question = validated["question"]
+    mode = validated.get("mode", "answer")
+    retriever = validated.get("retriever", "auto")
+    top_k = int(validated.get("top_k", 5) or 5)
+    document_id = validated.get("document_id")
     answer_mode = (
         (request.data.get("answer_mode") if isinstance(request.data, dict) else None)
-        or ser.validated_data.get("answer_mode")
+        or validated.get("answer_mode")
         or "sources_only"
     )
     # accept UI-friendly alias
@@ -949,22 +735,27 @@ def ask(request):
 
     if document_id is not None:
         document_id = int(document_id)
-    ws = get_or_create_default_workspace()
+    ws_id = default_workspace_id()
 
     # Idempotency (optional)
-    idem_key = request.headers.get("Idempotency-Key") or request.headers.get("X-Idempotency-Key") or request.META.get("HTTP_IDEMPOTENCY_KEY") or request.META.get("HTTP_X_IDEMPOTENCY_KEY")
-    if idem_key:
-        idem_key = normalize_idempotency_key(idem_key)
-
-    actor_id = (int(request.user.id) if getattr(request.user, "is_authenticated", False) else None)
+    idem_key = idempotency_key_from_request(request)
 
-    payload_for_idem = {"workspace_id": getattr(ws, "id", None), "actor_id": actor_id, "mode": mode, "question": question, "retriever": retriever, "top_k": top_k, "document_id": document_id, "answer_mode": answer_mode}
-
-    r_hash = request_hash(payload_for_idem)
+    # ask hashes only the behavior-changing fields (_ASK_HASH_KEYS): no actor/workspace
+    r_hash = ""
+    if idem_key:
+        r_hash = request_hash({"mode": mode, "question": question, "retriever": retriever, "top_k": top_k, "document_id": document_id, "answer_mode": answer_mode})
 
     # 1) Idempotency replay
     if idem_key:
-        existing = IdempotencyKey.objects.filter(key=idem_key).first()
+        cached = get_idempotent_replay(idem_key, r_hash)
+        if cached is not None:
+            return cached
+        existing = (
+            IdempotencyKey.objects.select_related("run")
+            .filter(key=idem_key)
+            .only("request_hash", "response_json", "run__id", "run__status", "run__question", "run__final_output")
+            .first()
+        )
         if existing:
             if existing.request_hash != r_hash:
                 return Response(
@@ -974,18 +765,29 @@ def ask(request):
                     },
                     status=409,
                 )
+            if existing.response_json is not None:
+                # replay body persisted by an earlier replay of this key
+                set_idempotent_replay(idem_key, r_hash, existing.response_json)
+                return Response(existing.response_json)
             if existing.run_id:
-                run = AgentRun.objects.get(id=existing.run_id)
+                # key + run came in one join; one more query fetches the latest
+                # step per replay name (DISTINCT ON, served by ix_agentstep_run_name_id)
+                run = existing.run
+                run.replay_steps = list(
+                    AgentStep.objects.filter(run_id=run.id, name__in=REPLAY_STEP_NAMES)
+                    .order_by("name", "-id")
+                    .distinct("name")
+                )
                 sources = get_sources_from_run(run)
 
                 # best-effort: retriever_used from latest retrieve_context step
-                step = AgentStep.objects.filter(run=run, name="retrieve_context").order_by("-id").first()
+                step = _latest_step(run, "retrieve_context")
                 retriever_used = ""
                 if step and isinstance(step.output_json, dict):
                     retriever_used = step.output_json.get("retriever_used") or ""
 
                 # best-effort: llm_used / answer_mode from generate_answer step
-                gen = AgentStep.objects.filter(run=run, name="generate_answer").order_by("-id").first()
+                gen = _latest_step(run, "generate_answer")
                 llm_used_prev = getattr(run, "llm_used", None)
                 answer_mode_prev = ""
                 if gen and isinstance(getattr(gen, "output_json", None), dict):
@@ -1006,10 +808,11 @@ def ask(request):
                     )
                 )
                 if route_replay == "doc_rag":
-                    answer_replay = _format_doc_answer(run.question or "", _strip_noise_sections(run.final_output or ""))
+                    stripped = _strip_noise_sections(run.final_output or "")
+                    answer_replay = _format_doc_answer(run.question or "", stripped)
                     sources_replay = sanitize_sources(
                         _filter_sources_by_citations(
-                            _strip_noise_sections(run.final_output or ""),
+                            stripped,
                             sources,
                             max_items=3,
                         )
@@ -1045,39 +848,50 @@ def ask(request):
                     "notice": notice_replay,
                     "idempotent_replay": True,
                 }
+                # a run still in flight may not have its final_output yet; once it
+                # has finished, persist the body so later replays skip the rebuild
+                if run.status in FINISHED_RUN_STATUSES:
+                    IdempotencyKey.objects.filter(key=idem_key).update(response_json=resp)
+                    set_idempotent_replay(idem_key, r_hash, resp)
                 return Response(resp)
-# 2) Create run (new execution)
-    run = AgentRun.objects.create(
-        workspace=ws,
-        user=None,
-        question=question,
-        mode=mode,
-        status="running",
-    )
-
-    if idem_key:
-        IdempotencyKey.objects.update_or_create(
-            key=idem_key,
-            defaults={
-                "workspace": ws,
-                "request_hash": r_hash,
-                "run": run,
-            },
+    # 2) Create run (new execution): run + key commit together; retrieval and
+    # LLM calls stay outside so no transaction is held open across them
+    with transaction.atomic():
+        run = AgentRun.objects.create(
+            workspace_id=ws_id,
+            user=None,
+            question=question,
+            mode=mode,
+            status="running",
         )
+        if idem_key:
+            upsert_idempotency_key(
+                IdempotencyKey(key=idem_key, workspace_id=ws_id, request_hash=r_hash, run=run),
+                update_fields=("workspace", "request_hash", "run"),
+            )
 
+    # retrieval trace built before an LLM call; kept if that call raises
+    retrieve_step = None
     try:
         retrieved = []
         retriever_used = "keyword"
         llm_used = "none"
 
-        summary_triggers = ("о чем", "про что", "кратко", "краткое содержание", "summary", "summarize", "обзор", "суть", "главное", "основная мысль", "идея", "выжимка")
-        q_lower = (question or "").strip().lower()
-        is_summary = document_id is not None and answer_mode != "sources_only" and any(t in q_lower for t in summary_triggers)
+        is_summary = (
+            document_id is not None
+            and answer_mode != "sources_only"
+            and SUMMARY_TRIGGERS_RE.search((question or "").strip().lower()) is not None
+        )
 
         if is_summary:
-            chunks_qs = EmbeddingChunk.objects.filter(document_id=document_id).select_related("document").order_by("chunk_index")
-            chunks = list(chunks_qs)
-            if not chunks:
+            # pick up to 12 evenly spaced chunks from the (cheap) ordered id list,
+            # then load text only for those rows
+            chunk_ids = list(
+                EmbeddingChunk.objects.filter(document_id=document_id)
+                .order_by("chunk_index")
+                .values_list("id", flat=True)
+            )
+            if not chunk_ids:
                 run.status = "success"
                 run.final_output = "Нет фрагментов в документе."
                 run.save(update_fields=["status", "final_output"])
@@ -1091,11 +905,10 @@ def ask(request):
                     "route": "summary",
                     "notice": "",
                 })
-            n = len(chunks)
-            if n <= 12:
-                selected = chunks
-            else:
-                selected = [chunks[int(round(i * (n - 1) / 11))] for i in range(12)]
+            n = len(chunk_ids)
+            if n > 12:
+                chunk_ids = [chunk_ids[int(round(i * (n - 1) / 11))] for i in range(12)]
+            selected = EmbeddingChunk.objects.filter(id__in=chunk_ids).select_related("document").order_by("chunk_index")
             retrieved = []
             for ch in selected:
                 txt = (ch.text or "")[:3500]
@@ -1107,38 +920,32 @@ def ask(request):
                     "snippet": (ch.text or "")[:300],
                     "text": txt,
                 })
-            AgentStep.objects.create(
+            safe_sources = sanitize_sources(retrieved)
+            retrieve_step = AgentStep(
                 run=run,
                 name="retrieve_context",
                 input_json={"question": question, "document_id": document_id},
-                output_json={"results": sanitize_sources(retrieved), "retriever_used": "summary"},
+                output_json={"results": safe_sources, "retriever_used": "summary"},
                 status="ok",
             )
             out = rag_answer_openai(question, retrieved)
             llm_used = out.get("llm_used", "openai")
             run.status = "success"
             run.final_output = out.get("answer", "")
-            run.save(update_fields=["status", "final_output"])
-            try:
-                if hasattr(run, "llm_used"):
-                    run.llm_used = llm_used
-                    run.save(update_fields=["llm_used"])
-            except Exception:
-                pass
-            try:
-                AgentStep.objects.create(
+            _finish_run(run, [
+                retrieve_step,
+                AgentStep(
                     run=run,
                     name="generate_answer",
                     input_json={"question": question, "answer_mode": answer_mode, "document_id": document_id},
                     output_json={"llm_used": llm_used, "answer_mode": answer_mode, "route": "summary", "answer_preview": (run.final_output or "")[:500]},
                     status="success",
-                )
-            except Exception:
-                pass
+                ),
+            ])
             return Response({
                 "run_id": run.id,
                 "answer": _strip_noise_sections(run.final_output or ""),
-                "sources": sanitize_sources(retrieved),
+                "sources": safe_sources,
                 "retriever_used": "summary",
                 "llm_used": llm_used,
                 "answer_mode": answer_mode,
@@ -1147,20 +954,20 @@ def ask(request):
             })
 
         if retriever == "keyword":
-            retrieved = keyword_retrieve(ws.id, question, top_k=top_k, document_id=document_id)
+            retrieved = keyword_retrieve(ws_id, question, top_k=top_k, document_id=document_id)
             retriever_used = "keyword"
 
         elif retriever == "vector":
-            query_vec = embed_texts([question])[0] if (question or "").strip() else []
-            retrieved = vector_retrieve(ws.id, query_vec, top_k=top_k, document_id=document_id) if query_vec else []
+            query_vec = embed_query(question)
+            retrieved = vector_retrieve(ws_id, query_vec, top_k=top_k, document_id=document_id) if query_vec else []
             retriever_used = "vector"
 
         elif retriever == "hybrid":
-            retrieved = hybrid_retrieve(ws.id, question, top_k=top_k, document_id=document_id)
+            retrieved = hybrid_retrieve(ws_id, question, top_k=top_k, document_id=document_id)
             retriever_used = "hybrid"
 
         else:  # auto -> hybrid (default)
-            retrieved = hybrid_retrieve(ws.id, question, top_k=top_k, document_id=document_id)
+            retrieved = hybrid_retrieve(ws_id, question, top_k=top_k, document_id=document_id)
             retriever_used = "hybrid"
 
         if document_id is not None and not retrieved:
@@ -1182,20 +989,20 @@ def ask(request):
                 })
             # MVP: if user scoped to a document, keep doc mode even on weak retrieval
             retriever_used = "doc_fallback"
-            if not retrieved:
-                try:
-                    notice = (notice + ";doc_fallback_empty") if notice else "doc_fallback_empty"
-                except Exception:
-                    notice = "doc_fallback_empty"
 
         V_THR = 0.55
         V_HARD = 0.70
         KW_THR = 4
-        if retriever_used == "keyword":
-            best_kw = max((float(r.get("score") or 0) for r in retrieved), default=0)
-        else:
-            best_kw = max((float(r.get("keyword_score") or 0) for r in retrieved), default=0)
-        best_vec = max((float(r.get("vector_score") or 0) for r in retrieved), default=0)
+        # one pass over the hits for all routing maxima (0 when nothing was retrieved)
+        kw_field = "score" if retriever_used == "keyword" else "keyword_score"
+        best_kw = best_vec = max_score = 0
+        if retrieved:
+            best_kw = best_vec = max_score = float("-inf")
+            for r in retrieved:
+                vec = float(r.get("vector_score") or 0)
+                best_kw = max(best_kw, float(r.get(kw_field) or 0))
+                best_vec = max(best_vec, vec)
+                max_score = max(max_score, float(r.get("final_score") or vec or r.get("score") or 0))
         # Keyword evidence must be non-trivial (avoid false hits like "есть")
         kw_evidence = _has_nontrivial_kw_terms(retrieved)
         has_kw_hit = bool(kw_evidence)
@@ -1206,12 +1013,12 @@ def ask(request):
             and _has_first_person_intro(retrieved) and _is_authorish_question(question)
         )
         doc_meta_intent = bool(document_id is not None and _is_doc_metadata_question(question))
-        doc_title_intent = bool(document_id is not None and _is_doc_title_question(question))
+        # title intents are a subset of metadata intents (same anchors): only re-check on a metadata hit
+        doc_title_intent = doc_meta_intent and _is_doc_title_question(question)
         doc_title_value = ""
         if doc_title_intent:
             doc_title_value = (Document.objects.filter(id=document_id).values_list("title", flat=True).first() or "").strip()
         relevant = ((best_kw >= KW_THR) and kw_evidence) or (has_kw_hit and best_vec >= V_THR) or (document_id is None and best_vec >= V_HARD)
-        max_score = max((float(r.get("final_score") or r.get("vector_score") or r.get("score") or 0) for r in retrieved), default=0)
 
         # Hard gate: keep NO-DOC out of doc_rag, but don't over-prune borderline DOC queries.
         # "велосипед" had max_score≈0.52, so 0.55 still routes to general.
@@ -1241,18 +1048,21 @@ def ask(request):
             "top_k": top_k,
         }
 
+        # sanitized once, shared by the stored step and the response body
+        safe_sources = sanitize_sources(retrieved)
+
         if answer_mode == "sources_only":
             AgentStep.objects.create(
                 run=run,
                 name="retrieve_context",
                 input_json={"question": question, "top_k": top_k, "retriever": retriever, "document_id": document_id},
-                output_json={"results": sanitize_sources(retrieved), "retriever_used": retriever_used, "route": "doc_rag", "notice": "", "debug": debug_payload},
+                output_json={"results": safe_sources, "retriever_used": retriever_used, "route": "doc_rag", "notice": "", "debug": debug_payload},
                 status="ok",
             )
             return Response({
                 "run_id": run.id,
-                "answer": _strip_noise_sections(""),
-                "sources": sanitize_sources(retrieved),
+                "answer": "",
+                "sources": safe_sources,
                 "retriever_used": retriever_used,
                 "llm_used": "none",
                 "answer_mode": answer_mode,
@@ -1262,24 +1072,17 @@ def ask(request):
             })
 
         if doc_title_intent and doc_title_value and retrieved:
-            AgentStep.objects.create(
-                run=run,
-                name="retrieve_context",
-                input_json={"question": question, "top_k": top_k, "retriever": retriever, "document_id": document_id},
-                output_json={"results": sanitize_sources(retrieved), "retriever_used": retriever_used, "route": "doc_rag", "notice": "", "debug": debug_payload},
-                status="ok",
-            )
             run.status = "success"
             run.final_output = doc_title_value
-            run.save(update_fields=["status", "final_output"])
-            try:
-                if hasattr(run, "llm_used"):
-                    run.llm_used = "none"
-                    run.save(update_fields=["llm_used"])
-            except Exception:
-                pass
-            try:
-                AgentStep.objects.create(
+            _finish_run(run, [
+                AgentStep(
+                    run=run,
+                    name="retrieve_context",
+                    input_json={"question": question, "top_k": top_k, "retriever": retriever, "document_id": document_id},
+                    output_json={"results": safe_sources, "retriever_used": retriever_used, "route": "doc_rag", "notice": "", "debug": debug_payload},
+                    status="ok",
+                ),
+                AgentStep(
                     run=run,
                     name="generate_answer",
                     input_json={"question": question, "answer_mode": answer_mode, "document_id": document_id},
@@ -1290,13 +1093,12 @@ def ask(request):
                         "answer_preview": (run.final_output or "")[:500],
                     },
                     status="success",
-                )
-            except Exception:
-                pass
+                ),
+            ])
             return Response({
                 "run_id": run.id,
                 "answer": _strip_noise_sections(run.final_output or ""),
-                "sources": sanitize_sources(retrieved),
+                "sources": safe_sources,
                 "retriever_used": retriever_used,
                 "llm_used": "none",
                 "answer_mode": answer_mode,
@@ -1310,48 +1112,36 @@ def ask(request):
                 notice = _add_out_of_doc_notice("", document_id)
                 general_answer = _general_answer_deterministic(question)
                 llm_used = "none"
-                AgentStep.objects.create(
-                    run=run,
-                    name="retrieve_context",
-                    input_json={"question": question, "top_k": top_k, "retriever": retriever, "document_id": document_id},
-                    output_json={
-                        "results": [],
-                        "retriever_used": "general",
-                        "route": "general",
-                        "best_kw": best_kw,
-                        "best_vec": best_vec,
-                        "retriever_requested": retriever,
-                        "notice": notice,
-                        "debug": debug_payload,
-                    },
-                    status="ok",
-                )
                 run.status = "success"
                 run.final_output = general_answer
-                run.save(update_fields=["status", "final_output"])
-                try:
-                    if hasattr(run, "llm_used"):
-                        run.llm_used = llm_used
-                        run.save(update_fields=["llm_used"])
-                except Exception:
-                    pass
-                try:
-                    AgentStep.objects.create(
+                _finish_run(run, [
+                    AgentStep(
+                        run=run,
+                        name="retrieve_context",
+                        input_json={"question": question, "top_k": top_k, "retriever": retriever, "document_id": document_id},
+                        output_json={
+                            "results": [],
+                            "retriever_used": "general",
+                            "route": "general",
+                            "best_kw": best_kw,
+                            "best_vec": best_vec,
+                            "retriever_requested": retriever,
+                            "notice": notice,
+                            "debug": debug_payload,
+                        },
+                        status="ok",
+                    ),
+                    AgentStep(
                         run=run,
                         name="generate_answer",
                         input_json={"question": question, "answer_mode": answer_mode},
                         output_json={"llm_used": llm_used, "answer_mode": answer_mode, "route": "general", "answer_preview": (run.final_output or "")[:500]},
                         status="success",
-                    )
-                except Exception:
-                    pass
+                    ),
+                ])
                 return Response({
                     "run_id": run.id,
-                    "answer": (
-                        _strip_noise_sections(run.final_output or "")
-                        if answer_mode in ("deterministic", "sources_only")
-                        else _strip_noise_sections(run.final_output or "")
-                    ),
+                    "answer": _strip_noise_sections(run.final_output or ""),
                     "sources": [],
                     "retriever_used": "general",
                     "llm_used": llm_used,
@@ -1372,34 +1162,26 @@ def ask(request):
                 general_answer = general_answer
                 llm_used = out.get("llm_used", "openai")
 
-            AgentStep.objects.create(
-                run=run,
-                name="retrieve_context",
-                input_json={"question": question, "top_k": top_k, "retriever": retriever, "document_id": document_id},
-                output_json={
-                    "results": [],
-                    "retriever_used": "general",
-                    "route": "general",
-                    "best_kw": best_kw,
-                    "best_vec": best_vec,
-                    "retriever_requested": retriever,
-                    "notice": notice,
-                    "debug": debug_payload,
-                },
-                status="ok",
-            )
-
             run.status = "success"
             run.final_output = general_answer
-            run.save(update_fields=["status", "final_output"])
-            try:
-                if hasattr(run, "llm_used"):
-                    run.llm_used = llm_used
-                    run.save(update_fields=["llm_used"])
-            except Exception:
-                pass
-            try:
-                AgentStep.objects.create(
+            _finish_run(run, [
+                AgentStep(
+                    run=run,
+                    name="retrieve_context",
+                    input_json={"question": question, "top_k": top_k, "retriever": retriever, "document_id": document_id},
+                    output_json={
+                        "results": [],
+                        "retriever_used": "general",
+                        "route": "general",
+                        "best_kw": best_kw,
+                        "best_vec": best_vec,
+                        "retriever_requested": retriever,
+                        "notice": notice,
+                        "debug": debug_payload,
+                    },
+                    status="ok",
+                ),
+                AgentStep(
                     run=run,
                     name="generate_answer",
                     input_json={"question": question, "answer_mode": answer_mode},
@@ -1410,17 +1192,12 @@ def ask(request):
                         "answer_preview": (run.final_output or "")[:500],
                     },
                     status="success",
-                )
-            except Exception:
-                pass
+                ),
+            ])
 
             return Response({
                 "run_id": run.id,
-                "answer": (
-                    _strip_noise_sections(run.final_output or "")
-                    if answer_mode in ("deterministic", "sources_only")
-                    else _strip_noise_sections(run.final_output or "")
-                ),
+                "answer": _strip_noise_sections(run.final_output or ""),
                 "sources": [],
                 "retriever_used": "general",
                 "llm_used": llm_used,
@@ -1441,48 +1218,36 @@ def ask(request):
                 # skip repair for general answers (MVP clean LLM)
                 general_answer = general_answer
                 llm_used = out.get("llm_used", "openai")
-            AgentStep.objects.create(
-                run=run,
-                name="retrieve_context",
-                input_json={"question": question, "top_k": top_k, "retriever": retriever, "document_id": document_id},
-                output_json={
-                    "results": [],
-                    "retriever_used": "general",
-                    "route": "general",
-                    "best_kw": best_kw,
-                    "best_vec": best_vec,
-                    "retriever_requested": retriever,
-                    "notice": notice,
-                    "debug": debug_payload,
-                },
-                status="ok",
-            )
             run.status = "success"
             run.final_output = general_answer
-            run.save(update_fields=["status", "final_output"])
-            try:
-                if hasattr(run, "llm_used"):
-                    run.llm_used = llm_used
-                    run.save(update_fields=["llm_used"])
-            except Exception:
-                pass
-            try:
-                AgentStep.objects.create(
+            _finish_run(run, [
+                AgentStep(
+                    run=run,
+                    name="retrieve_context",
+                    input_json={"question": question, "top_k": top_k, "retriever": retriever, "document_id": document_id},
+                    output_json={
+                        "results": [],
+                        "retriever_used": "general",
+                        "route": "general",
+                        "best_kw": best_kw,
+                        "best_vec": best_vec,
+                        "retriever_requested": retriever,
+                        "notice": notice,
+                        "debug": debug_payload,
+                    },
+                    status="ok",
+                ),
+                AgentStep(
                     run=run,
                     name="generate_answer",
                     input_json={"question": question, "answer_mode": answer_mode},
                     output_json={"llm_used": llm_used, "answer_mode": answer_mode, "route": "general", "answer_preview": (run.final_output or "")[:500]},
                     status="success",
-                )
-            except Exception:
-                pass
+                ),
+            ])
             return Response({
                 "run_id": run.id,
-                "answer": (
-                    _strip_noise_sections(run.final_output or "")
-                    if answer_mode in ("deterministic", "sources_only")
-                    else _strip_noise_sections(run.final_output or "")
-                ),
+                "answer": _strip_noise_sections(run.final_output or ""),
                 "sources": [],
                 "retriever_used": "general",
                 "llm_used": llm_used,
@@ -1492,11 +1257,11 @@ def ask(request):
                 "debug": debug_payload,
             })
 
-        AgentStep.objects.create(
+        retrieve_step = AgentStep(
             run=run,
             name="retrieve_context",
             input_json={"question": question, "top_k": top_k, "retriever": retriever, "document_id": document_id},
-            output_json={"results": sanitize_sources(retrieved), "retriever_used": retriever_used, "route": "doc_rag", "notice": "", "debug": debug_payload},
+            output_json={"results": safe_sources, "retriever_used": retriever_used, "route": "doc_rag", "notice": "", "debug": debug_payload},
             status="ok",
         )
 
@@ -1514,22 +1279,13 @@ def ask(request):
         else:
             run.status = "error"
             run.error = f"unknown answer_mode: {answer_mode}"
-            run.save(update_fields=["status","error"])
-            return Response({"run_id": run.id, "error": run.error, "sources": sanitize_sources(retrieved), "retriever_used": retriever_used, "llm_used": "none", "answer_mode": answer_mode}, status=400)
-        run.save(update_fields=["status", "final_output"])
-
+            _finish_run(run, [retrieve_step], fields=("status", "error"))
+            return Response({"run_id": run.id, "error": run.error, "sources": safe_sources, "retriever_used": retriever_used, "llm_used": "none", "answer_mode": answer_mode}, status=400)
 
         # persist generate_answer step for idempotent replay consistency
-        try:
-            # store llm_used on run if model has such field
-            if hasattr(run, "llm_used"):
-                run.llm_used = llm_used
-                run.save(update_fields=["llm_used"])
-        except Exception:
-            pass
-
-        try:
-            AgentStep.objects.create(
+        _finish_run(run, [
+            retrieve_step,
+            AgentStep(
                 run=run,
                 name="generate_answer",
                 input_json={"question": question, "answer_mode": answer_mode},
@@ -1539,17 +1295,17 @@ def ask(request):
                     "answer_preview": (run.final_output or "")[:500],
                 },
                 status="success",
-            )
-        except Exception:
-            pass
+            ),
+        ])
 
+        stripped = _strip_noise_sections(run.final_output or "")
         return Response(
             {
                 "run_id": run.id,
-                "answer": _format_doc_answer(question, _strip_noise_sections(run.final_output or "")),
+                "answer": _format_doc_answer(question, stripped),
                 "sources": sanitize_sources(
                     _filter_sources_by_citations(
-                        _strip_noise_sections(run.final_output or ""),
+                        stripped,
                         retrieved,
                         max_items=3,
                     )
@@ -1564,16 +1320,20 @@ def ask(request):
         )
 
     except Exception as e:
-        AgentStep.objects.create(
-            run=run,
-            name="retrieve_context",
-            input_json={"question": question},
-            output_json={"error": str(e)},
-            status="error",
-        )
         run.status = "error"
         run.error = str(e)
-        run.save(update_fields=["status", "error"])
+        # a step already saved by _finish_run has its pk set: don't insert it twice
+        steps = [retrieve_step] if retrieve_step is not None and retrieve_step.pk is None else []
+        steps.append(
+            AgentStep(
+                run=run,
+                name="retrieve_context",
+                input_json={"question": question},
+                output_json={"error": str(e)},
+                status="error",
+            )
+        )
+        _finish_run(run, steps, fields=("status", "error"))
         return Response({"run_id": run.id, "llm_used": llm_used,  "error": str(e)}, status=500)
 
 # --------------------
@@ -1582,39 +1342,65 @@ def ask(request):
 
 @api_view(["GET"])
 def runs_list(request):
-    ws = get_or_create_default_workspace()
-    qs = AgentRun.objects.filter(workspace=ws).order_by("-id")[:50]
-    return Response(AgentRunSerializer(qs, many=True).data)
+    ws_id = default_workspace_id()
+    limit, offset = _limit_offset(request)
+    key = f"runs_list:{ws_id}:{limit}:{offset}"
+    rows = cache_get(key)
+    if rows is None:
+        qs = AgentRun.objects.filter(workspace_id=ws_id).order_by("-id")[offset:offset + limit]
+        rows = run_rows(qs)
+        cache_set(key, rows, LIST_TTL)
+    return Response(rows)
 
 @api_view(["GET"])
 def run_detail(request, run_id: int):
-    ws = get_or_create_default_workspace()
-    run = AgentRun.objects.get(workspace=ws, id=run_id)
-    return Response(AgentRunDetailSerializer(run).data)
+    ws_id = default_workspace_id()
+    key = f"run_detail:{ws_id}:{run_id}"
+    data = cache_get(key)
+    if data is None:
+        run = get_object_or_404(
+            AgentRun.objects.only(*AGENT_RUN_DETAIL_FIELDS),
+            workspace_id=ws_id,
+            pk=run_id,
+        )
+        data = AgentRunDetailSerializer(run).data
+        # finished runs never change; running ones are always read fresh
+        if run.status in FINISHED_RUN_STATUSES:
+            cache_set(key, dict(data), FINISHED_RUN_TTL)
+    return Response(data)
 
 @api_view(["GET"])
 def run_steps(request, run_id: int):
-    ws = get_or_create_default_workspace()
-    run = AgentRun.objects.get(workspace=ws, id=run_id)
-    steps = run.steps.order_by("id")
-    return Response(AgentStepSerializer(steps, many=True).data)
-from django.http import JsonResponse
+    ws_id = default_workspace_id()
+    key = f"run_steps:{ws_id}:{run_id}"
+    rows = cache_get(key)
+    if rows is None:
+        run = get_object_or_404(AgentRun.objects.only("id", "status"), workspace_id=ws_id, pk=run_id)
+        rows = step_rows(AgentStep.objects.filter(run_id=run.id).order_by("id"))
+        if run.status in FINISHED_RUN_STATUSES:
+            cache_set(key, rows, FINISHED_RUN_TTL)
+    return Response(rows)
+
+
+# static payload: serialized once at import (same bytes JsonResponse produced)
+_API_INDEX_BODY = json.dumps({
+    "service": "ProductOps Copilot API",
+    "endpoints": {
+        "health": "/api/health/",
+        "upload_text": "/api/kb/upload_text/",
+        "documents": "/api/kb/documents/",
+        "document_detail": "/api/kb/documents/<id>/",
+        "ask": "/api/ask/",
+        "runs": "/api/runs/",
+        "run_detail": "/api/runs/<id>/",
+        "run_steps": "/api/runs/<id>/steps/",
+    },
+    "quickstart": {
+        "health": "curl -fsS http://localhost:8001/api/health/ | jq .",
+        "upload_text": "curl -fsS -X POST http://localhost:8001/api/kb/upload_text/ -H 'Content-Type: application/json' -d '{\"title\":\"t\",\"content\":\"hello\"}' | jq .",
+    }
+}).encode()
+
 
 def api_index(request):
-    return JsonResponse({
-        "service": "ProductOps Copilot API",
-        "endpoints": {
-            "health": "/api/health/",
-            "upload_text": "/api/kb/upload_text/",
-            "documents": "/api/kb/documents/",
-            "document_detail": "/api/kb/documents/<id>/",
-            "ask": "/api/ask/",
-            "runs": "/api/runs/",
-            "run_detail": "/api/runs/<id>/",
-            "run_steps": "/api/runs/<id>/steps/",
-        },
-        "quickstart": {
-            "health": "curl -fsS http://localhost:8001/api/health/ | jq .",
-            "upload_text": "curl -fsS -X POST http://localhost:8001/api/kb/upload_text/ -H 'Content-Type: application/json' -d '{\"title\":\"t\",\"content\":\"hello\"}' | jq .",
-        }
-    })
+    return HttpResponse(_API_INDEX_BODY, content_type="application/json")
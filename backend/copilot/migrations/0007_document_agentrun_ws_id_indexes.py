@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-16 02:28
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('copilot', '0006_document_file_path'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agentrun',
+            index=models.Index(fields=['workspace', '-id'], name='ix_agentrun_ws_id_desc'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['workspace', '-id'], name='ix_document_ws_id_desc'),
+        ),
+    ]
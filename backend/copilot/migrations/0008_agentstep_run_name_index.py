@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-16 02:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('copilot', '0007_document_agentrun_ws_id_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agentstep',
+            index=models.Index(fields=['run', 'name', '-id'], name='ix_agentstep_run_name_id'),
+        ),
+    ]
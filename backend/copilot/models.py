@@ -37,6 +37,11 @@ class Document(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["workspace", "-id"], name="ix_document_ws_id_desc"),
+        ]
+
 class EmbeddingChunk(models.Model):
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name="chunks")
     chunk_index = models.IntegerField()
@@ -77,6 +82,11 @@ class AgentRun(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["workspace", "-id"], name="ix_agentrun_ws_id_desc"),
+        ]
+
 class AgentStep(models.Model):
     run = models.ForeignKey(AgentRun, on_delete=models.CASCADE, related_name="steps")
     name = models.CharField(max_length=64)
@@ -84,3 +94,8 @@ class AgentStep(models.Model):
     output_json = models.JSONField(default=dict, blank=True)
     status = models.CharField(max_length=32, default="ok")  # ok/error
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["run", "name", "-id"], name="ix_agentstep_run_name_id"),
+        ]
@@ -1,6 +1,7 @@
 import hashlib
 import os
 import random
+from functools import lru_cache
 from typing import List
 
 DIM = int(os.getenv("EMBEDDINGS_DIM", "1536"))
@@ -20,3 +21,19 @@ def embed_texts(texts: List[str]) -> List[List[float]]:
     if PROVIDER == "stub":
         return [_stub_embed_one(t, DIM) for t in texts]
     raise RuntimeError(f"Unsupported EMBEDDINGS_PROVIDER={PROVIDER!r} (only 'stub' for now)")
+
+
+# each entry is a DIM-float tuple (~50 KB at 1536 dims): keep the per-process cache small
+@lru_cache(maxsize=int(os.getenv("EMBEDDINGS_QUERY_CACHE_SIZE", "128")))
+def _embed_query_cached(text: str) -> tuple:
+    return tuple(embed_texts([text])[0])
+
+
+def embed_query(text: str) -> List[float]:
+    """
+    Embed a single search query, memoized per process.
+    Retries and repeated questions skip the provider call; returns a fresh list.
+    """
+    if not (text or "").strip():
+        return []
+    return list(_embed_query_cached(text))
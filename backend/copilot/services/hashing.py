@@ -0,0 +1,14 @@
+import hashlib
+
+HASH_CHUNK_CHARS = 64 * 1024
+
+
+def sha256_text(text: str) -> str:
+    """SHA-256 of UTF-8 text; large texts are encoded slice by slice so peak memory stays flat."""
+    text = text or ""
+    if len(text) <= HASH_CHUNK_CHARS:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+    h = hashlib.sha256()
+    for i in range(0, len(text), HASH_CHUNK_CHARS):
+        h.update(text[i:i + HASH_CHUNK_CHARS].encode("utf-8"))
+    return h.hexdigest()
@@ -1,14 +1,25 @@
 from __future__ import annotations
 
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List
 
-from copilot.services.embeddings import embed_texts
+from copilot.services.embeddings import embed_query
 from copilot.services.vector_retriever import vector_retrieve
 from copilot.services.retriever import keyword_retrieve
 
 _WORD_RE = re.compile(r"[0-9A-Za-zА-Яа-яЁё_]{2,}")
 
+# Query embedding (a provider call, no DB access) runs here while the request
+# thread does the keyword search. Both searches stay on the request's own DB
+# connection, so this pool never draws from DB_POOL_MAX. At most one embedding
+# per request thread is in flight, hence the GUNICORN_THREADS default.
+_EMBED_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv("HYBRID_EMBED_WORKERS", os.getenv("GUNICORN_THREADS", "8"))),
+    thread_name_prefix="hybrid-embed",
+)
+
 
 def _query_terms(question: str) -> List[str]:
     terms = [t.lower() for t in _WORD_RE.findall(question or "")]
@@ -26,9 +37,10 @@ def hybrid_retrieve(workspace_id: int, question: str, top_k: int = 5, document_i
     terms = _query_terms(question)
     terms_set = set(terms)
 
-    query_vec = embed_texts([question])[0] if (question or "").strip() else []
-    v_res = vector_retrieve(workspace_id, query_vec, top_k=expand, document_id=document_id) if query_vec else []
+    vec_future = _EMBED_POOL.submit(embed_query, question)
     k_res = keyword_retrieve(workspace_id, question, top_k=expand, document_id=document_id)
+    query_vec = vec_future.result()
+    v_res = vector_retrieve(workspace_id, query_vec, top_k=expand, document_id=document_id) if query_vec else []
 
     merged: Dict[int, Dict[str, Any]] = {}
 
@@ -1,7 +1,27 @@
 import re
+from typing import Optional
+
+from copilot.models import IdempotencyKey
 
 def normalize_idempotency_key(key: str) -> str:
     k = (key or "").strip()
     # allow letters/digits/._- up to 128
     k = re.sub(r"[^a-zA-Z0-9._-]+", "-", k)
     return k[:128]
+
+
+def idempotency_key_from_request(request) -> Optional[str]:
+    """Normalized Idempotency-Key (or X-Idempotency-Key) header, None when absent."""
+    meta = request.META  # request.headers would case-fold every header on first use
+    raw = meta.get("HTTP_IDEMPOTENCY_KEY") or meta.get("HTTP_X_IDEMPOTENCY_KEY")
+    return normalize_idempotency_key(raw) if raw else None
+
+
+def upsert_idempotency_key(obj: IdempotencyKey, update_fields) -> None:
+    """Single INSERT ... ON CONFLICT (key) DO UPDATE instead of update_or_create's SELECT + write."""
+    IdempotencyKey.objects.bulk_create(
+        [obj],
+        update_conflicts=True,
+        unique_fields=["key"],
+        update_fields=list(update_fields),
+    )
@@ -1,8 +1,13 @@
+import hashlib
+import json
 import os
 import re
-from typing import List, Dict, Any, Sequence, Optional
+import threading
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import Callable, List, Dict, Any, Sequence, Optional
 
-from openai import OpenAI
+from copilot.services.response_cache import cache_get, cache_set
 
 CYRILLIC_RE = re.compile(r"[А-Яа-яЁё]")
 
@@ -23,6 +28,62 @@ def _openai_available() -> bool:
     return bool(os.getenv("OPENAI_API_KEY", "").strip())
 
 
+@lru_cache(maxsize=1)
+def _openai_client():
+    # Lazy import: the openai SDK takes ~0.4s to import and is only needed when
+    # a key is configured and an LLM call is actually made.
+    # One client per process (thread-safe): its HTTP pool keeps connections to
+    # the API alive across requests instead of a new TLS handshake per call.
+    from openai import OpenAI
+
+    return OpenAI()
+
+
+_NOISE_SECTION_RE = re.compile(r"(?m)^\s*(Примечания:|Дополнительно:)\s*$", re.IGNORECASE)
+
+
+# Exact-match answer cache for real model calls: same model + question (+ same
+# retrieved chunks for RAG) -> reuse the previous answer. 0 disables it.
+LLM_ANSWER_CACHE_TTL = _env_int("LLM_ANSWER_CACHE_TTL", 3600)
+
+# Singleflight for cache misses: concurrent identical asks in this process wait
+# for the first one's model call instead of each making their own.
+_INFLIGHT: Dict[str, Future] = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def _cached_answer(kind: str, question: str, chunk_ids: Sequence, compute: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    if LLM_ANSWER_CACHE_TTL <= 0 or not _openai_available():
+        return compute()
+    blob = json.dumps(
+        [kind, os.getenv("OPENAI_MODEL", "gpt-5-mini"), " ".join((question or "").split()), list(chunk_ids)],
+        ensure_ascii=False,
+    )
+    key = "llm_answer:" + hashlib.sha256(blob.encode("utf-8")).hexdigest()
+    hit = cache_get(key)
+    if isinstance(hit, dict):
+        return dict(hit)
+    with _INFLIGHT_LOCK:
+        pending = _INFLIGHT.get(key)
+        if pending is None:
+            _INFLIGHT[key] = flight = Future()
+    if pending is not None:
+        return dict(pending.result())
+    try:
+        out = compute()
+        # deterministic/no-LLM fallbacks are cheap: only cache actual model output
+        if out.get("llm_used") not in (None, "none"):
+            cache_set(key, out, LLM_ANSWER_CACHE_TTL)
+        flight.set_result(out)
+        return out
+    except BaseException as e:
+        flight.set_exception(e)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+
+
 def _strip_noise_sections(text: str) -> str:
     """
     Remove noise headings and everything after them.
@@ -30,11 +91,7 @@ def _strip_noise_sections(text: str) -> str:
     """
     if not text:
         return ""
-    noise = re.compile(
-        r"(?m)^\s*(Примечания:|Дополнительно:)\s*$",
-        re.IGNORECASE,
-    )
-    m = noise.search(text)
+    m = _NOISE_SECTION_RE.search(text)
     if m:
         text = text[: m.start()].rstrip()
     return text.strip()
@@ -128,19 +185,17 @@ def _build_general_template(question: str, lang: str = "en") -> str:
 
 def _normalize_general_output(text: str, topic_hint: str, lang: Optional[str] = None) -> str:
     """Enforce fallback UX: disclaimer, general answer, hint (≤10 lines). Uses lang or detect_lang."""
-    if lang is None:
-        lang = detect_lang(topic_hint or text)
-    template = _build_general_template(topic_hint, lang=lang)
     t = (text or "").strip()
-    if not t:
-        return template
-    hint_ru = GENERAL_HINTS["ru"]
-    hint_en = GENERAL_HINTS["en"]
-    has_disclaimer = "В этом документе нет информации" in t or "This document does not contain information" in t
-    has_hint = hint_ru in t or hint_en in t
-    has_legacy = any(h in t for h in LEGACY_GENERAL_HEADINGS)
-    if not has_disclaimer or not has_hint or has_legacy:
-        return template
+    if (
+        not t
+        or not ("В этом документе нет информации" in t or "This document does not contain information" in t)
+        or not (GENERAL_HINTS["ru"] in t or GENERAL_HINTS["en"] in t)
+        or any(h in t for h in LEGACY_GENERAL_HEADINGS)
+    ):
+        # template is only built when it is actually returned
+        if lang is None:
+            lang = detect_lang(topic_hint or text)
+        return _build_general_template(topic_hint, lang=lang)
     lines = [ln.rstrip() for ln in t.splitlines() if ln.strip()]
     if len(lines) > 10:
         lines = lines[:10]
@@ -208,8 +263,13 @@ def _extract_author_name_from_snippets(retrieved: List[Dict[str, Any]]) -> tuple
 def rag_answer_openai(question: str, retrieved: List[Dict[str, Any]]) -> Dict[str, Any]:
     """
     Returns dict: { "answer": str, "llm_used": str }
-    Uses Responses API.
+    Uses Responses API; answers are cached per question + top-5 chunk ids.
     """
+    chunk_ids = [(r or {}).get("chunk_id") for r in (retrieved or [])[:5]]
+    return _cached_answer("rag", question, chunk_ids, lambda: _rag_answer_openai(question, retrieved))
+
+
+def _rag_answer_openai(question: str, retrieved: List[Dict[str, Any]]) -> Dict[str, Any]:
     lang = detect_lang(question)
     retrieved = (retrieved or [])[:5]
     
@@ -302,7 +362,7 @@ def rag_answer_openai(question: str, retrieved: List[Dict[str, Any]]) -> Dict[st
 
     user = f"Question:\n{question}\n\nContext:\n{context}"
 
-    client = OpenAI()
+    client = _openai_client()
     resp = client.responses.create(
         model=model,
         input=[
@@ -352,9 +412,13 @@ def rag_answer_openai(question: str, retrieved: List[Dict[str, Any]]) -> Dict[st
 
 def general_answer_openai(question: str) -> Dict[str, Any]:
     """
-    General answer (no RAG context). Same env vars as rag_answer_openai.
+    General answer (no RAG context). Same env vars (and answer cache) as rag_answer_openai.
     Returns dict: { "answer": str, "llm_used": str }
     """
+    return _cached_answer("general", question, (), lambda: _general_answer_openai(question))
+
+
+def _general_answer_openai(question: str) -> Dict[str, Any]:
     topic = (question or "").strip() or "заданной теме"
     lang = detect_lang(question)
     if not _openai_available():
@@ -381,7 +445,7 @@ def general_answer_openai(question: str) -> Dict[str, Any]:
             "Не упоминай документы, источники, поиск или ограничения. "
             "Ответ должен быть кратким."
         )
-    client = OpenAI()
+    client = _openai_client()
     resp = client.responses.create(
         model=model,
         input=[
@@ -395,110 +459,6 @@ def general_answer_openai(question: str) -> Dict[str, Any]:
     return {"answer": ans, "llm_used": model}
 
 
-def repair_fallback_openai(question: str, draft: str) -> Dict[str, Any]:
-    """
-    Rewrite draft into fallback template (RU or EN by question language). Same env vars as general_answer_openai.
-    Returns dict: { "answer": str, "llm_used": str }
-    """
-    lang = detect_lang(question)
-    topic = (question or "").strip() or ("заданной теме" if lang == "ru" else "your question")
-    if not _openai_available():
-        if (draft or "").strip():
-            return {"answer": (draft or "").strip(), "llm_used": "none"}
-        return {"answer": _build_general_template(topic, lang=lang), "llm_used": "none"}
-    model = os.getenv("OPENAI_MODEL", "gpt-5-mini")
-    effort = os.getenv("OPENAI_REASONING_EFFORT", "low")
-    max_out = _env_int("OPENAI_MAX_OUTPUT_TOKENS", 300)
-    hint = GENERAL_HINTS.get(lang, GENERAL_HINT)
-    if lang == "en":
-        system = (
-            "Rewrite the draft into the fallback format. Output in English only, <=8 non-empty lines.\n"
-            "1) Line 1: 'This document does not contain information about <question>.'\n"
-            "2) Line 2 starts with: 'General answer (outside the document):'\n"
-            "3) Lines 3-5: 2-4 short bullet lines (<=20 words)\n"
-            f"4) Last line MUST be exactly: '{hint}'\n"
-            "Remove legacy headings/boilerplate. No document snippets. No fabricated citations.\n"
-        )
-    else:
-        system = (
-            "Rewrite the draft into the fallback format. Output in Russian only, <=8 non-empty lines.\n"
-            "1) Line 1: 'В этом документе нет информации о <question>.'\n"
-            "2) Line 2 starts with: 'Общий ответ вне документа:'\n"
-            "3) Lines 3-5: 2-4 short bullet lines (<=20 words)\n"
-            f"4) Last line MUST be exactly: '{hint}'\n"
-            "Remove legacy headings/boilerplate. No document snippets. No fabricated citations.\n"
-        )
-    user = f"Question:\n{question}\n\nDraft to rewrite:\n{draft}"
-    client = OpenAI()
-    resp = client.responses.create(
-        model=model,
-        input=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
-        reasoning={"effort": effort},
-        max_output_tokens=max_out,
-    )
-    ans = _normalize_general_output((resp.output_text or "").strip(), topic, lang=lang)
-    return {"answer": ans, "llm_used": model}
-
-
-def repair_doc_answer_openai(question: str, context: str, draft: str) -> Dict[str, Any]:
-    """
-    Rewrite draft into strict doc-answer format. EN: Answer/Quotes/Sources. RU: Ответ/Цитаты/Источники. Preserve citation indices [1]..
-    Returns dict: { "answer": str, "llm_used": str }
-    """
-    lang = detect_lang(question)
-    if not _openai_available():
-        if (draft or "").strip():
-            return {"answer": (draft or "").strip(), "llm_used": "none"}
-        if lang == "en":
-            parts = ["Answer: The document does not contain a direct answer to this question.", "", "Sources:"]
-        else:
-            parts = ["Ответ: В документе нет прямого ответа на этот вопрос.", "", "Источники:"]
-        for i, block in enumerate((context or "").split("\n\n")[:3], start=1):
-            line = block.strip().split("\n", 1)[-1].strip()[:200] if block.strip() else ""
-            if line:
-                parts.append(f"- {line} [{i}]")
-        if len(parts) == 3:
-            parts.append("(no fragments)" if lang == "en" else "(нет фрагментов)")
-        return {"answer": "\n".join(parts), "llm_used": "none"}
-    model = os.getenv("OPENAI_MODEL", "gpt-5-mini")
-    effort = os.getenv("OPENAI_REASONING_EFFORT", "low")
-    max_out = _env_int("OPENAI_MAX_OUTPUT_TOKENS", 300)
-    lang_instruction = "Output in English only. " if lang == "en" else "Output in Russian only. "
-    if lang == "en":
-        system = (
-            "Rewrite the draft into the strict RAG format. " + lang_instruction +
-            "Format strictly: (1) Answer: 1–2 sentences; each sentence must end with citations like [1] or [1][2]. "
-            "(2) Optional Quotes: 1–3 lines; each line = short quote (≤30 words) verbatim from context + citation [n]. "
-            "(3) Sources: 2–5 items; each = short quote (≤30 words) verbatim from context + citation [n]. "
-            "Preserve citation indices [1], [2], ... Never output Cyrillic. "
-            "If the context does not contain the answer, output 'Answer: The document does not contain a direct answer to this question.' and Sources: empty or at most 1 snippet with citation."
-        )
-    else:
-        system = (
-            "Rewrite the draft into the strict RAG format. " + lang_instruction +
-            "Format strictly: (1) Ответ: 1–2 sentences; each sentence must end with citations like [1] or [1][2]. "
-            "(2) Optional Цитаты: 1–3 lines; each line = short quote (≤30 words) verbatim from context + citation [n]. "
-            "(3) Источники: 2–5 items; each = short quote (≤30 words) verbatim from context + citation [n]. "
-            "Preserve citation indices [1], [2], ... "
-            "If the context does not contain the answer, output 'Ответ: В документе нет прямого ответа на этот вопрос.' and Источники: empty or at most 1 snippet with citation."
-        )
-    user = f"Question:\n{question}\n\nContext:\n{context}\n\nDraft to rewrite:\n{draft}"
-    client = OpenAI()
-    resp = client.responses.create(
-        model=model,
-        input=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
-        reasoning={"effort": effort},
-        max_output_tokens=max_out,
-    )
-    return {"answer": resp.output_text or "", "llm_used": model}
-
-
 # Back-compat alias: some code imports rag_answer_langchain
 def rag_answer_langchain(question, retrieved):
     # If you already have rag_answer_openai, reuse it
@@ -0,0 +1,48 @@
+from typing import Any, Optional
+
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from copilot.api.renderers import ORJSONRenderer
+
+# Read-endpoint cache TTLs (seconds)
+LIST_TTL = 5  # kb_documents / runs_list: bounded staleness
+FINISHED_RUN_TTL = 300  # run_detail / run_steps of success/error runs (immutable)
+
+FINISHED_RUN_STATUSES = ("success", "error")
+
+IDEMPOTENCY_REPLAY_TTL = 24 * 3600  # replayed responses for a given Idempotency-Key never change
+
+_JSON_RENDERER = ORJSONRenderer()
+
+
+def cache_get(key: str) -> Optional[Any]:
+    """Best-effort cache read: a cache outage must never fail the request."""
+    try:
+        return cache.get(key)
+    except Exception:
+        return None
+
+
+def cache_set(key: str, value: Any, ttl: int) -> None:
+    try:
+        cache.set(key, value, ttl)
+    except Exception:
+        pass
+
+
+def get_idempotent_replay(idem_key: str, r_hash: str) -> Optional[HttpResponse]:
+    """
+    Ready-to-send replay for this key, only if it was stored for the same request_hash.
+    The body is cached already rendered, so a hit skips JSON parsing and DRF rendering.
+    """
+    hit = cache_get(f"idem:{idem_key}")
+    if isinstance(hit, dict) and hit.get("request_hash") == r_hash and hit.get("body") is not None:
+        return HttpResponse(hit["body"], content_type="application/json")
+    return None
+
+
+def set_idempotent_replay(idem_key: str, r_hash: str, response: dict) -> None:
+    # same bytes the API's renderer would produce for Response(response)
+    body = _JSON_RENDERER.render(response)
+    cache_set(f"idem:{idem_key}", {"request_hash": r_hash, "body": body}, IDEMPOTENCY_REPLAY_TTL)
@@ -1,15 +1,34 @@
-import hashlib
-
 from celery import shared_task
 from django.db import transaction
 
 from copilot.models import Document, EmbeddingChunk
 from copilot.services.chunking import chunk_text
 from copilot.services.embeddings import embed_texts
+from copilot.services.hashing import sha256_text
 
 
-def sha256_text(text: str) -> str:
-    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+def _embeddings_by_text(doc: Document) -> dict:
+    """
+    text -> vector from another embedded document in the same workspace with the
+    same content_hash (re-uploads of the same text), or {} if there is none.
+    """
+    if not doc.content_hash:
+        return {}
+    twin_id = (
+        Document.objects
+        .filter(workspace_id=doc.workspace_id, content_hash=doc.content_hash, status="embedded")
+        .exclude(id=doc.id)
+        .values_list("id", flat=True)
+        .first()
+    )
+    if twin_id is None:
+        return {}
+    return dict(
+        EmbeddingChunk.objects
+        .filter(document_id=twin_id)
+        .exclude(embedding__isnull=True)
+        .values_list("text", "embedding")
+    )
 
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 5})
@@ -79,20 +98,21 @@ def process_document(self, document_id: int) -> dict:
                 for i, c in enumerate(chunks)
             ]
             if objs:
+                # Compute embeddings up front (stub for now); chunks already embedded
+                # for an identical document are reused instead of re-embedded.
+                known = _embeddings_by_text(doc)
+                missing = list(dict.fromkeys(o.text for o in objs if o.text not in known))
+                if missing:
+                    known.update(zip(missing, embed_texts(missing)))
+                for o in objs:
+                    o.embedding = known.get(o.text)
                 EmbeddingChunk.objects.bulk_create(objs)
 
-                # Compute + persist embeddings (stub for now)
-                chunks_qs = EmbeddingChunk.objects.filter(document=doc).order_by("chunk_index")
-                texts = [c.text for c in chunks_qs]
-                vectors = embed_texts(texts) if texts else []
-                for c, v in zip(chunks_qs, vectors):
-                    c.embedding = v
-                    c.save(update_fields=["embedding"])
-
             doc.status = "embedded"
             doc.chunk_count = len(chunks)
-            doc.content_hash = sha256_text(doc.content or "")
-            doc.save(update_fields=["status", "chunk_count", "content_hash"])
+            # content_hash was written at upload (or right after extraction above)
+            # and content hasn't changed since, so don't hash the body again.
+            doc.save(update_fields=["status", "chunk_count"])
 
         return {"document_id": doc.id, "status": doc.status, "chunks": doc.chunk_count}
 
@@ -0,0 +1,15 @@
+# Loaded automatically by gunicorn from the working directory (/app), so the
+# Dockerfile CMD, entrypoints/web.sh and docker-compose all pick it up.
+import os
+
+# ask() spends most of its time waiting on the LLM / embeddings APIs: threaded
+# workers let other requests run while one is blocked on the network.
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+# DB budget per worker: each request thread can hold one pooled connection for
+# the whole request (including the LLM wait), and so would any helper thread
+# that queries the DB. Keep threads + DB-using helper threads <= DB_POOL_MAX.
+# hybrid_retrieve's embedding pool (HYBRID_EMBED_WORKERS) does no DB work, so
+# today the sum is just threads: 8 <= DB_POOL_MAX=10.
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))